@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+#coding=utf-8
+"""
+Compares row-by-row and bulk construction in TreeMaker.add_from.
+
+Usage: python benchmarks/add_from.py [ntaxa ...]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from treemaker import TreeMaker
+from generate import make_rows
+
+
+def timed(rows, scoped, bulk):
+    """Returns (seconds, newick) for building `rows`"""
+    t = TreeMaker(scoped=scoped)
+    start = time.time()
+    t.add_from(rows, bulk=bulk)
+    return time.time() - start, t.write()
+
+
+if __name__ == '__main__':
+    sizes = [int(n) for n in sys.argv[1:]] or [10000, 100000]
+    print("%-10s %-8s %10s %10s %8s" % (
+        'taxa', 'scoped', 'rows (s)', 'bulk (s)', 'speedup'
+    ))
+    for ntaxa in sizes:
+        rows = make_rows(ntaxa)
+        for scoped in (False, True):
+            serial, expected = timed(rows, scoped, bulk=False)
+            bulk, newick = timed(rows, scoped, bulk=True)
+            assert newick == expected, "bulk build differs"
+            print("%-10d %-8s %10.3f %10.3f %7.1fx" % (
+                ntaxa, scoped, serial, bulk, serial / bulk
+            ))
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+#coding=utf-8
+"""
+Synthetic classifications for benchmarking treemaker.
+
+Usage: python benchmarks/generate.py ntaxa [depth] [branching] > classification.txt
+"""
+import sys
+import random
+
+
+def _weights(n, skew):
+    """Returns Zipf-like weights for choosing among `n` options"""
+    return [1.0 / (i + 1) ** skew for i in range(n)]
+
+
+def make_classification(ntaxa, depth=6, branching=4, skew=1.0, reuse=0.0,
+                        family_size=500, seed=12345):
+    """
+    Returns `ntaxa` (taxon, classification) rows with a realistic shape:
+    a few large families and many small ones, subgroups of varying depth,
+    and (optionally) generic subgroup labels shared between branches.
+
+    Args:
+        ntaxa (int): number of taxa.
+        depth (int): maximum number of subgroup levels below a family.
+        branching (int): number of possible subgroups at each level.
+        skew (float): how unevenly taxa are spread over families and
+            subgroups (0 = evenly, larger = a few big groups).
+        reuse (float): probability that a subgroup gets a generic label
+            (e.g. "subgroup 1") that also appears in other branches.
+        family_size (int): average number of taxa per family.
+        seed (int): random seed.
+
+    Returns:
+        List[tuple]: (taxon, classification) rows.
+    """
+    rng = random.Random(seed)
+    nfamilies = max(1, ntaxa // family_size)
+    families = list(range(nfamilies))
+    family_weights = _weights(nfamilies, skew)
+    subgroups = list(range(branching))
+    subgroup_weights = _weights(branching, skew)
+    rows = []
+    for i in range(ntaxa):
+        family = rng.choices(families, family_weights)[0]
+        path = ["Family %d" % family]
+        for level in range(rng.randint(0, depth)):
+            subgroup = rng.choices(subgroups, subgroup_weights)[0]
+            if rng.random() < reuse:
+                path.append("subgroup %d" % subgroup)
+            else:
+                path.append("%s-%d" % (path[-1], subgroup))
+        rows.append(("taxon%d" % i, ", ".join(path)))
+    return rows
+
+
+def make_rows(ntaxa, seed=12345):
+    """Returns `ntaxa` (taxon, classification) rows for testing"""
+    return make_classification(ntaxa, skew=0.0, seed=seed)
+
+
+def write_rows(rows, filename):
+    """Writes `rows` to `filename` as a classification file"""
+    with open(filename, 'w') as handle:
+        for taxon, classification in rows:
+            handle.write("%s\t%s\n" % (taxon, classification))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit(__doc__.strip())
+    args = [int(a) for a in sys.argv[1:4]]
+    for taxon, classification in make_classification(*args):
+        sys.stdout.write("%s\t%s\n" % (taxon, classification))
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+#coding=utf-8
+"""
+Reports the memory used per node by each TreeMaker backend.
+
+Usage: python benchmarks/memory.py [ntaxa ...]
+"""
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from treemaker import TreeMaker
+from generate import make_rows
+
+
+def count_nodes(tree):
+    """Counts the nodes in `tree`"""
+    return sum(1 for node in tree.preorder())
+
+
+def measure(rows, backend):
+    """Returns (nodes, bytes used) for building `rows` with `backend`"""
+    tracemalloc.start()
+    t = TreeMaker(scoped=True, backend=backend)
+    t.add_from(rows)
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return count_nodes(t.tree), used
+
+
+if __name__ == '__main__':
+    sizes = [int(n) for n in sys.argv[1:]] or [1000, 10000, 100000]
+    print("%-10s %-8s %10s %14s %10s" % (
+        'taxa', 'backend', 'nodes', 'bytes', 'bytes/node'
+    ))
+    for ntaxa in sizes:
+        rows = make_rows(ntaxa)
+        for backend in ('tree', 'compact'):
+            nodes, used = measure(rows, backend)
+            print("%-10d %-8s %10d %14d %10.1f" % (
+                ntaxa, backend, nodes, used, used / float(nodes)
+            ))
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+#coding=utf-8
+"""
+Compares the text and memory-mapped readers used by TreeMaker.read.
+
+Usage: python benchmarks/read.py [ntaxa ...]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from treemaker import TreeMaker
+from treemaker.treemaker import _text_rows, _mmap_rows
+from generate import make_rows, write_rows
+
+
+def timed(function, *args, **kwargs):
+    """Returns (seconds, result) of calling `function`"""
+    start = time.time()
+    result = function(*args, **kwargs)
+    return time.time() - start, result
+
+
+if __name__ == '__main__':
+    sizes = [int(n) for n in sys.argv[1:]] or [100000, 1000000]
+    tmpdir = tempfile.mkdtemp()
+    print("%-10s %-8s %10s %10s" % ('taxa', 'reader', 'parse (s)', 'read (s)'))
+    try:
+        for ntaxa in sizes:
+            filename = os.path.join(tmpdir, '%d.txt' % ntaxa)
+            write_rows(make_rows(ntaxa), filename)
+            expected = None
+            for name, reader in (('text', _text_rows), ('mmap', _mmap_rows)):
+                parse, rows = timed(lambda: list(reader(filename)))
+                assert expected is None or rows == expected, "readers differ"
+                expected = rows
+                read, _ = timed(
+                    TreeMaker().read, filename, memory_map=(name == 'mmap')
+                )
+                print("%-10d %-8s %10.3f %10.3f" % (ntaxa, name, parse, read))
+    finally:
+        shutil.rmtree(tmpdir)
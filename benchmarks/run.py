@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+#coding=utf-8
+"""
+Runs the treemaker benchmark suite on synthetic classifications, saves the
+timings as JSON, and compares them against a stored baseline.
+
+Usage:
+    python benchmarks/run.py --save-baseline baseline.json
+    python benchmarks/run.py --baseline baseline.json [--threshold 0.25]
+
+Exits with status 1 if any benchmark is slower than the baseline by more
+than the threshold.
+"""
+import os
+import sys
+import json
+import random
+import argparse
+import platform
+import tempfile
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from treemaker import TreeMaker, VERSION
+from generate import make_classification, write_rows
+
+SIZES = [1000, 10000, 100000, 1000000]
+LOOKUPS = 10000
+
+
+def best_of(repeat, function, *args):
+    """Returns the fastest of `repeat` runs of `function(*args)` in seconds"""
+    best = None
+    for i in range(repeat):
+        start = timer()
+        function(*args)
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def build(rows, scoped, bulk=False):
+    t = TreeMaker(scoped=scoped)
+    if bulk:
+        t.add_from(rows, bulk=True)
+    else:
+        for taxon, classification in rows:
+            t.add(taxon, classification)
+    return t
+
+
+def lookup(tree, labels):
+    for label in labels:
+        tree.get(label)
+
+
+def write(t, mode):
+    t.tree._clear_newick()  # time a cold write, not the cached fragments
+    t.write(mode)
+
+
+def run_size(ntaxa, args):
+    """Returns {name: seconds} for one tree size"""
+    rows = make_classification(
+        ntaxa, depth=args.depth, branching=args.branching, skew=args.skew,
+        reuse=args.reuse, seed=args.seed
+    )
+    handle, filename = tempfile.mkstemp(suffix='.txt')
+    os.close(handle)
+    write_rows(rows, filename)
+    rng = random.Random(args.seed)
+    labels = [taxon for taxon, c in rng.sample(rows, min(LOOKUPS, ntaxa))]
+    results = {}
+    try:
+        for scoped in (False, True):
+            mode = 'scoped' if scoped else 'unscoped'
+            key = lambda name: "%s/%s/%d" % (name, mode, ntaxa)
+            results[key('read')] = best_of(
+                args.repeat, lambda: TreeMaker(scoped=scoped).read(filename)
+            )
+            results[key('add')] = best_of(args.repeat, build, rows, scoped)
+            results[key('add_from')] = best_of(
+                args.repeat, build, rows, scoped, True
+            )
+            t = build(rows, scoped, bulk=True)
+            results[key('get')] = best_of(args.repeat, lookup, t.tree, labels)
+            results[key('tips')] = best_of(
+                args.repeat, lambda: list(t.tree.tips())
+            )
+            for output in ('newick', 'nexus'):
+                results[key('write-%s' % output)] = best_of(
+                    args.repeat, write, t, output
+                )
+            del t
+    finally:
+        os.unlink(filename)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints how `results` compare to `baseline`.
+
+    Returns:
+        List[str]: the benchmarks that got slower than `threshold` allows.
+    """
+    regressions = []
+    print("%-32s %10s %10s %8s" % ('benchmark', 'base (s)', 'now (s)', 'ratio'))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        ratio = results[name] / baseline[name] if baseline[name] else 1.0
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = '  SLOWER'
+        print("%-32s %10.4f %10.4f %7.2fx%s" % (
+            name, baseline[name], results[name], ratio, flag
+        ))
+    return regressions
+
+
+def parse_options(args):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0]
+    )
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=SIZES,
+        help="number of taxa to benchmark (default: %s)" % SIZES
+    )
+    parser.add_argument('--depth', type=int, default=6)
+    parser.add_argument('--branching', type=int, default=4)
+    parser.add_argument('--skew', type=float, default=1.0)
+    parser.add_argument('--reuse', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=12345)
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help="runs per benchmark, the fastest is kept (default: 3)"
+    )
+    parser.add_argument('-o', '--output', help="save the results to this file")
+    parser.add_argument(
+        '--save-baseline', dest='save_baseline',
+        help="save the results as the baseline in this file"
+    )
+    parser.add_argument('--baseline', help="compare against this baseline")
+    parser.add_argument(
+        '--threshold', type=float, default=0.25,
+        help="allowed slow-down before a benchmark fails (default: 0.25)"
+    )
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    options = parse_options(sys.argv[1:] if args is None else args)
+    results = {}
+    for ntaxa in options.sizes:
+        results.update(run_size(ntaxa, options))
+    report = {
+        'treemaker': VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {
+            'depth': options.depth, 'branching': options.branching,
+            'skew': options.skew, 'reuse': options.reuse,
+            'seed': options.seed, 'repeat': options.repeat,
+        },
+        'results': results,
+    }
+    for filename in (options.output, options.save_baseline):
+        if filename:
+            with open(filename, 'w') as handle:
+                json.dump(report, handle, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as handle:
+            baseline = json.load(handle)
+        if baseline.get('parameters') != report['parameters']:
+            sys.stderr.write("warning: baseline used different parameters\n")
+        regressions = compare(results, baseline['results'], options.threshold)
+        if regressions:
+            print("%d benchmark(s) slower than baseline" % len(regressions))
+            return 1
+    else:
+        for name in sorted(results):
+            print("%-32s %10.4f" % (name, results[name]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
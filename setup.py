@@ -47,7 +47,12 @@ setup(
     keywords='phylogenetics newick taxonomy',
     packages=find_packages(),
     package_dir={},
-    install_requires=[],
+    install_requires=[
+        'futures; python_version == "2.7"',  # concurrent.futures backport
+    ],
+    extras_require={
+        'distances': ['numpy'],
+    },
     entry_points={
         'console_scripts': [
             'treemaker = treemaker:main'
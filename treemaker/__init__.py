@@ -1 +1,2 @@
-from .treemaker import VERSION, Tree, TreeMaker, parse_args, main
+from .treemaker import VERSION, Tree, TreeMaker, parse_args, parse_options, main
+from .stats import Stats
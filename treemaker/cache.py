@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#coding=utf-8
+"""
+An on-disk cache of built trees, keyed on the content of the input file.
+"""
+__author__ = 'Simon J. Greenhill <simon@simon.net.nz>'
+__copyright__ = 'Copyright (c) 2018 Simon J. Greenhill'
+__license__ = 'New-style BSD'
+
+import os
+import hashlib
+
+from .treemaker import VERSION
+from .snapshot import FORMAT_VERSION, save, load
+
+DEFAULT_MAX_SIZE = 1 << 30  # bytes
+SUFFIX = '.snapshot'
+
+
+class BuildCache(object):
+    """
+    A directory of tree snapshots keyed on a SHA-256 hash of the input file
+    and the settings that change the tree built from it (label, nodelabels,
+    scoped and the treemaker version). When the cache grows beyond
+    `max_size` bytes the least recently used snapshots are removed.
+
+    >>> cache = BuildCache("~/.cache/treemaker")
+    >>> t = TreeMaker()
+    >>> t.read("classification.txt", cache=cache)
+
+    Args:
+        directory (str): the cache directory, created if needed.
+        max_size (int): the largest the cache may grow, in bytes
+            (default=1GB)
+
+    Attributes:
+        hits (int): lookups that found a stored tree.
+        misses (int): lookups that did not.
+    """
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = os.path.expanduser(directory)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def key(self, filename, maker):
+        """
+        Returns the cache key for reading `filename` into `maker`.
+
+        Args:
+            filename (str): the classification file.
+            maker (treemaker.TreeMaker): the TreeMaker it will be read into.
+
+        Returns:
+            str: a hexadecimal SHA-256 digest.
+        """
+        digest = hashlib.sha256()
+        settings = u"%s\0%d\0%s\0%s\0%s\0%s\0" % (
+            VERSION, FORMAT_VERSION, type(maker).__name__, maker.tree.node,
+            maker.tree.show_nodelabels, maker.scoped
+        )
+        digest.update(settings.encode('utf8'))
+        with open(filename, 'rb') as handle:
+            for block in iter(lambda: handle.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def get(self, key, backend="tree"):
+        """
+        Returns the TreeMaker stored under `key`, or None if there is none.
+        Unreadable entries are removed and count as a miss.
+
+        Args:
+            key (str): a key from `key`.
+            backend (str): how the loaded tree is stored, "tree" or "compact".
+
+        Returns:
+            treemaker.TreeMaker: the stored TreeMaker, or None.
+        """
+        path = self._path(key)
+        try:
+            maker = load(path, backend=backend)
+            os.utime(path, None)  # mark as recently used
+        except (IOError, OSError, ValueError):
+            self._remove(path)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return maker
+
+    def put(self, key, maker):
+        """
+        Stores the tree built by `maker` under `key`, then removes the least
+        recently used entries if the cache is too large.
+
+        Args:
+            key (str): a key from `key`.
+            maker (treemaker.TreeMaker): the TreeMaker to store.
+
+        Returns:
+            None
+        """
+        save(maker, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is no larger
+        than `max_size`.
+
+        Returns:
+            int: the number of entries removed.
+        """
+        entries, total = [], 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                info = os.stat(path)
+            except OSError:  # removed by another process
+                continue
+            entries.append((info.st_mtime, info.st_size, path))
+            total += info.st_size
+        entries.sort()
+        removed = 0
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            self._remove(path)
+            total -= size
+            removed += 1
+        return removed
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
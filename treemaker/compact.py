@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+#coding=utf-8
+"""Compact, array-backed storage for very large classification trees"""
+__author__ = 'Simon J. Greenhill <simon@simon.net.nz>'
+__copyright__ = 'Copyright (c) 2018 Simon J. Greenhill'
+__license__ = 'New-style BSD'
+
+from array import array
+from functools import total_ordering
+
+from .treemaker import Tree, Traversals, _as_label
+
+NO_NODE = -1
+# labels on more nodes than this are looked up through an index, not a scan
+INDEX_THRESHOLD = 16
+
+
+class CompactTree(object):
+    """
+    Array-backed tree to represent very large classification taxonomies.
+
+    Nodes are integers numbered in the order they were created, and the
+    structure is held in parallel integer arrays (parent, first child, next
+    sibling, ...) rather than one Python object per node. Labels are interned
+    in a shared label table so repeated clade labels are stored once.
+
+    Use `CompactTree.root` to get a `CompactNode`, which offers the same
+    interface as `Tree`.
+
+    Unlike `Tree`, this backend sorts on read: children are linked in the
+    order they were added, and a child whose label sorts before the last
+    child's marks the chain of its parent as out of order. The next read of
+    that node's children sorts the chain once and links it in label order,
+    so children added in label order (e.g. from a sorted file) are never
+    sorted, and later serializations do not sort again until a child is
+    added out of order.
+
+    `get` scans the nodes that have the label. Labels on more than
+    `INDEX_THRESHOLD` nodes (e.g. generic subgroup names) are instead kept
+    in an index of the first match below each of their ancestors, so that
+    lookups stay fast when labels are reused across the tree.
+
+    Args:
+        node (str): Label for the root node.
+        show_nodelabels (boolean): A flag to show nodelabels or not (default=False)
+    """
+    def __init__(self, node=None, show_nodelabels=False):
+        self.show_nodelabels = show_nodelabels
+        # label table
+        self.labels = []
+        self._label_ids = {}
+        self._first_with_label = array('i')
+        self._last_with_label = array('i')
+        self._label_count = array('i')
+        self._indexed = array('b')  # 1 if the label is in `_index`
+        # (node << 32 | label id) -> first node with the label below node
+        self._index = {}
+        # node arrays
+        self.label = array('i')
+        self.parent = array('i')
+        self.first_child = array('i')
+        self.last_child = array('i')
+        self.next_sibling = array('i')
+        self.nchildren = array('i')
+        self._unsorted = array('b')  # 1 if the children are not in order
+        self._next_with_label = array('i')
+        self._new_node('' if node is None else node, NO_NODE)
+
+    def __len__(self):
+        return len(self.label)
+
+    @property
+    def root(self):
+        """Returns the root node of the tree"""
+        return CompactNode(self, 0)
+
+    def _label_id(self, label):
+        lid = self._label_ids.get(label)
+        if lid is None:
+            lid = len(self.labels)
+            self.labels.append(label)
+            self._label_ids[label] = lid
+            self._first_with_label.append(NO_NODE)
+            self._last_with_label.append(NO_NODE)
+            self._label_count.append(0)
+            self._indexed.append(0)
+        return lid
+
+    def _new_node(self, label, parent):
+        lid = self._label_id(Tree._sanitise(_as_label(label)))
+        node = len(self.label)
+        self.label.append(lid)
+        self.parent.append(parent)
+        self.first_child.append(NO_NODE)
+        self.last_child.append(NO_NODE)
+        self.next_sibling.append(NO_NODE)
+        self.nchildren.append(0)
+        self._unsorted.append(0)
+        self._next_with_label.append(NO_NODE)
+        # chain of nodes sharing this label, in creation order
+        if self._last_with_label[lid] == NO_NODE:
+            self._first_with_label[lid] = node
+        else:
+            self._next_with_label[self._last_with_label[lid]] = node
+        self._last_with_label[lid] = node
+        self._label_count[lid] += 1
+        if parent != NO_NODE:
+            last = self.last_child[parent]
+            if last == NO_NODE:
+                self.first_child[parent] = node
+            else:
+                self.next_sibling[last] = node
+                if not self._unsorted[parent] and \
+                        self.labels[lid] < self.labels[self.label[last]]:
+                    self._unsorted[parent] = 1
+            self.last_child[parent] = node
+            self.nchildren[parent] += 1
+        if self._indexed[lid]:
+            self._register(node, lid)
+        elif self._label_count[lid] > INDEX_THRESHOLD:
+            self._indexed[lid] = 1
+            candidate = self._first_with_label[lid]
+            while candidate != NO_NODE:
+                self._register(candidate, lid)
+                candidate = self._next_with_label[candidate]
+        return node
+
+    def _register(self, node, lid):
+        """
+        Records `node` (labelled `lid`) in the index of each ancestor that
+        it is the first match below.
+        """
+        index, parent = self._index, self.parent
+        ancestor = parent[node]
+        while ancestor != NO_NODE:
+            key = ancestor << 32 | lid
+            current = index.get(key)
+            if current is not None and \
+                    self._path(current, ancestor) < self._path(node, ancestor):
+                # the existing match comes first here, so it also comes
+                # first in every ancestor further up.
+                break
+            index[key] = node
+            ancestor = parent[ancestor]
+
+    def add(self, parent, label):
+        """
+        Adds a node labelled `label` as the last child of `parent`.
+
+        Args:
+            parent (int): the parent node.
+            label (str): Label for the new node.
+
+        Returns:
+            int: the new node.
+        """
+        return self._new_node(label, parent)
+
+    def children(self, node):
+        """
+        Returns the children of `node` in label order, with children that
+        share a label in the order they were added (as in `Tree`). If
+        children were added out of order, they are sorted and linked in
+        label order first.
+
+        Args:
+            node (int): a node.
+
+        Returns:
+            List[int]: the child nodes.
+        """
+        out = []
+        child = self.first_child[node]
+        while child != NO_NODE:
+            out.append(child)
+            child = self.next_sibling[child]
+        if self._unsorted[node]:
+            # the sort is stable, and children that share a label are
+            # linked in the order they were added.
+            labels, label = self.labels, self.label
+            out.sort(key=lambda child: labels[label[child]])
+            next_sibling = self.next_sibling
+            for i in range(len(out) - 1):
+                next_sibling[out[i]] = out[i + 1]
+            next_sibling[out[-1]] = NO_NODE
+            self.first_child[node], self.last_child[node] = out[0], out[-1]
+            self._unsorted[node] = 0
+        return out
+
+    def get_child(self, parent, label):
+        """
+        Returns the first direct child of `parent` labelled `label`.
+
+        Args:
+            parent (int): the parent node.
+            label (str): Label for the child node.
+
+        Returns:
+            int: the matching child, or None.
+        """
+        lid = self._label_ids.get(label)
+        if lid is None:
+            return None
+        # scan whichever is shorter: the siblings or the nodes with the label.
+        if self.nchildren[parent] <= self._label_count[lid]:
+            child = self.first_child[parent]
+            while child != NO_NODE:
+                if self.label[child] == lid:
+                    return child
+                child = self.next_sibling[child]
+        else:
+            node = self._first_with_label[lid]
+            while node != NO_NODE:
+                if self.parent[node] == parent:
+                    return node
+                node = self._next_with_label[node]
+        return None
+
+    def _path(self, node, ancestor):
+        """
+        Returns the nodes from below `ancestor` down to `node`, or None if
+        `node` is not a descendant of `ancestor`.
+        """
+        path = []
+        while node != ancestor:
+            if node == NO_NODE:
+                return None
+            path.append(node)
+            node = self.parent[node]
+        path.reverse()
+        return path or None
+
+    def get(self, label, node=0):
+        """
+        Searches the subtree below `node` for `label`. If several nodes
+        match, the first one found in a depth-first search is returned.
+
+        Args:
+            label (str): Label for this node.
+            node (int): (optional) parent node. Default is the root.
+
+        Returns:
+            int: the first node matching `label`, or None.
+        """
+        lid = self._label_ids.get(label)
+        if lid is None:
+            return None
+        if self._indexed[lid]:
+            return self._index.get(node << 32 | lid)
+        # siblings are numbered in insertion order, so comparing the paths
+        # from `node` gives the depth-first order.
+        found, found_path = None, None
+        candidate = self._first_with_label[lid]
+        while candidate != NO_NODE:
+            path = self._path(candidate, node)
+            if path is not None and (found_path is None or path < found_path):
+                found, found_path = candidate, path
+            candidate = self._next_with_label[candidate]
+        return found
+
+    def tips(self, node=0):
+        """
+        Returns the tips below `node`.
+
+        Args:
+            node (int): (optional) parent node. Default is the root.
+
+        Returns:
+            List[int]: the tip nodes from the given node.
+        """
+        stack = self.children(node)[::-1]
+        while stack:
+            node = stack.pop()
+            if self.nchildren[node]:
+                stack.extend(self.children(node)[::-1])
+            else:
+                yield node
+
+    def newick(self, node=0):
+        """
+        Returns the Newick representation of the subtree below `node`
+        (without the terminating semicolon).
+
+        Returns:
+            str: the tree in Newick format.
+        """
+        return "".join(self._newick_chunks(node))
+
+    def _newick_chunks(self, node=0, translate=None):
+        labels, label, nchildren = self.labels, self.label, self.nchildren
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if not isinstance(node, int):
+                yield node
+                continue
+            # nodes with a single child are collapsed into that child.
+            while nchildren[node] == 1:
+                node = self.first_child[node]
+            if not nchildren[node]:
+                tip = labels[label[node]]
+                yield tip if translate is None else translate[tip]
+                continue
+            yield "("
+            stack.append(
+                ")%s" % labels[label[node]] if self.show_nodelabels else ")"
+            )
+            children = self.children(node)
+            stack.append(children[-1])
+            for child in reversed(children[:-1]):
+                stack.append(",")
+                stack.append(child)
+
+
+@total_ordering
+class CompactNode(Traversals):
+    """
+    A lightweight handle on one node of a `CompactTree` that has the same
+    interface as `Tree`. Handles are created on demand and hold no state
+    of their own.
+
+    Args:
+        tree (treemaker.compact.CompactTree): the tree.
+        id (int): the node.
+    """
+    __slots__ = ('tree', 'id')
+
+    def __init__(self, tree, id):
+        self.tree = tree
+        self.id = id
+
+    def _wrap(self, node):
+        return None if node is None else CompactNode(self.tree, node)
+
+    def __lt__(self, other):
+        return self.node < other.node
+
+    def __eq__(self, other):
+        return self.node == other.node
+
+    @property
+    def node(self):
+        """Returns the label of this node"""
+        return self.tree.labels[self.tree.label[self.id]]
+
+    @property
+    def show_nodelabels(self):
+        """Returns the nodelabel setting of the tree"""
+        return self.tree.show_nodelabels
+
+    @property
+    def parent(self):
+        """Returns the parent of this node, or None for the root"""
+        parent = self.tree.parent[self.id]
+        return None if parent == NO_NODE else self._wrap(parent)
+
+    @property
+    def children(self):
+        """Returns the children of this node"""
+        return [self._wrap(child) for child in self.tree.children(self.id)]
+
+    @property
+    def is_tip(self):
+        """Returns True if node is a tip"""
+        return self.tree.nchildren[self.id] == 0
+
+    @property
+    def is_node(self):
+        """Returns True if node is a node (i.e. has children)"""
+        return self.tree.nchildren[self.id] > 0
+
+    def add(self, node, children=None):
+        """
+        Adds a node (with optional children) to the tree. `Tree` and
+        `CompactNode` instances are copied into this tree.
+
+        Args:
+            node (str): Label for this node.
+            children (list): Optional list of children nodes
+
+        Returns:
+            treemaker.compact.CompactNode: the created node matching `label`.
+        """
+        if isinstance(node, (Tree, CompactNode)):
+            return self._copy(node)
+        new = self._wrap(self.tree.add(self.id, node))
+        if children is not None:
+            [new.add(child) for child in children]
+        return new
+
+    def _copy(self, source):
+        top = self.tree.add(self.id, source.node)
+        stack = [(child, top) for child in reversed(source.children)]
+        while stack:
+            source, parent = stack.pop()
+            node = self.tree.add(parent, source.node)
+            stack.extend((child, node) for child in reversed(source.children))
+        return self._wrap(top)
+
+    def get_or_create(self, label, scoped=False):
+        """
+        Helper function to get or create a node.
+
+        Args:
+            label (str): Label for this node.
+            scoped (boolean): Only look for `label` among the direct children
+                of this node rather than the whole subtree (default=False)
+
+        Returns:
+            treemaker.compact.CompactNode: the found or created node.
+        """
+        found = self.get_child(label) if scoped else self.get(label)
+        if found:
+            return found
+        return self.add(label)
+
+    def get(self, label, node=None):
+        """
+        Searches tree for node `label`.
+
+        Args:
+            label (str): Label for this node.
+            node (treemaker.compact.CompactNode): (optional) parent node.
+                Default is current node.
+
+        Returns:
+            treemaker.compact.CompactNode: the found node, or None.
+        """
+        node = self if node is None else node
+        return self._wrap(self.tree.get(label, node.id))
+
+    def get_child(self, label):
+        """
+        Returns the direct child of this node labelled `label`.
+
+        Args:
+            label (str): Label for the child node.
+
+        Returns:
+            treemaker.compact.CompactNode: the first matching child, or None.
+        """
+        return self._wrap(self.tree.get_child(self.id, label))
+
+    def newick(self):
+        """
+        Returns the Newick representation of the tree (without the
+        terminating semicolon).
+
+        Returns:
+            str: the tree in Newick format.
+        """
+        return self.tree.newick(self.id)
+
+    def _newick_chunks(self, translate=None):
+        return self.tree._newick_chunks(self.id, translate)
+
+    def __repr__(self):
+        return "<CompactNode: %s>" % self.node
+
+    def __str__(self):
+        return self.newick()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+#coding=utf-8
+"""
+Tip-by-tip distance matrices for a built tree. These need NumPy.
+
+Tips are taken in depth-first order, as in `Tree.tips`, so the most recent
+common ancestor of tips i < j is the shallowest of the common ancestors of
+each neighbouring pair of tips from i to j. Each row of the matrix is then a
+running minimum over the depths of those ancestors, which NumPy computes
+without a Python loop per entry.
+"""
+__author__ = 'Simon J. Greenhill <simon@simon.net.nz>'
+__copyright__ = 'Copyright (c) 2018 Simon J. Greenhill'
+__license__ = 'New-style BSD'
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+KINDS = ('shared', 'patristic')
+BLOCKSIZE = 256  # rows filled at a time
+
+
+def _check(kind):
+    if numpy is None:  # pragma: no cover
+        raise ImportError(
+            "Distance matrices need NumPy, please install it first"
+        )
+    if kind not in KINDS:
+        raise ValueError(
+            "Unknown distance. Please use 'shared' or 'patristic'"
+        )
+
+
+def _tip_depths(tree):
+    """
+    Returns the tips of `tree` and two integer arrays: the depth of each tip,
+    and the depth of the common ancestor of each tip and the next one.
+    """
+    tips, depths, shared = [], [], []
+    lowest = None  # shallowest node since the last tip
+    for node, depth, parent in tree.preorder(detailed=True):
+        if lowest is None or depth < lowest:
+            lowest = depth
+        if node.children or not depth:
+            continue
+        if tips:
+            # the first node after the last tip is a child of their ancestor
+            shared.append(lowest - 1)
+        tips.append(node)
+        depths.append(depth)
+        lowest = None
+    return (
+        tips, numpy.array(depths, dtype=numpy.int32),
+        numpy.array(shared, dtype=numpy.int32)
+    )
+
+
+def _fill(out, depths, shared, kind, start, stop):
+    """Fills rows `start` to `stop` of the matrix `out`"""
+    minimum = numpy.minimum.accumulate
+    row = numpy.empty(len(depths), dtype=numpy.int32)
+    for i in range(start, stop):
+        row[i] = depths[i]
+        if i:
+            row[:i] = minimum(shared[i - 1::-1])[::-1]
+        row[i + 1:] = minimum(shared[i:])
+        if kind == 'patristic':
+            out[i - start] = depths[i] + depths - 2 * row
+        else:
+            out[i - start] = row
+
+
+def _blocks(n, blocksize=BLOCKSIZE):
+    return [(i, min(i + blocksize, n)) for i in range(0, n, blocksize)]
+
+
+def distance_matrix(tree, kind="shared", dtype="float64", filename=None,
+                    workers=1):
+    """
+    Returns the matrix of distances between every pair of tips of `tree`,
+    in the order of `tree.tips()`.
+
+    Args:
+        tree (treemaker.Tree): the tree.
+        kind (str): One of:
+            * "shared" = the depth of the most recent common ancestor of the
+              two tips, i.e. the number of classification levels they share
+              below `tree`. On the diagonal this is the depth of the tip.
+            * "patristic" = the number of branches on the path between the
+              two tips.
+        dtype (str or numpy.dtype): the type of the matrix, e.g. "float32"
+            to halve the memory needed (default="float64")
+        filename (str): if given, the matrix is written to this NumPy
+            (".npy") file through a memory map rather than held in memory.
+        workers (int): the number of threads to fill the matrix with, in
+            blocks of rows (default=1)
+
+    Returns:
+        numpy.ndarray: an n x n matrix for n tips, or a `numpy.memmap` of
+            `filename`.
+
+    Raises:
+        ImportError: if NumPy is not installed.
+        ValueError: if kind is not "shared" or "patristic".
+    """
+    _check(kind)
+    tips, depths, shared = _tip_depths(tree)
+    n = len(tips)
+    if filename is None:
+        out = numpy.empty((n, n), dtype=dtype)
+    else:
+        out = numpy.lib.format.open_memmap(
+            filename, mode='w+', dtype=dtype, shape=(n, n)
+        )
+
+    def fill(block):
+        start, stop = block
+        _fill(out[start:stop], depths, shared, kind, start, stop)
+
+    if workers is not None and workers > 1 and n > BLOCKSIZE:
+        from concurrent.futures import ThreadPoolExecutor
+        # NumPy releases the GIL while it works on each row
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(fill, _blocks(n)))
+    else:
+        for block in _blocks(n):
+            fill(block)
+    if filename is not None:
+        out.flush()
+    return out
+
+
+def write_distances(tree, handle, kind="shared"):
+    """
+    Writes the distance matrix of `tree` (see `distance_matrix`) to `handle`
+    as tab-separated text, with a header row and the tip label at the start
+    of each row. The rows are computed a block at a time, so the whole
+    matrix is never held in memory.
+
+    Args:
+        tree (treemaker.Tree): the tree.
+        handle (file): a file-like object opened for writing text.
+        kind (str): "shared" or "patristic".
+
+    Returns:
+        None
+
+    Raises:
+        ImportError: if NumPy is not installed.
+        ValueError: if kind is not "shared" or "patristic".
+    """
+    _check(kind)
+    tips, depths, shared = _tip_depths(tree)
+    labels = [tip.node for tip in tips]
+    handle.write("\t".join(["taxon"] + labels) + "\n")
+    for start, stop in _blocks(len(tips)):
+        block = numpy.empty((stop - start, len(tips)), dtype=numpy.int32)
+        _fill(block, depths, shared, kind, start, stop)
+        handle.write("".join(
+            "%s\t%s\n" % (label, "\t".join(map(str, row)))
+            for label, row in zip(labels[start:stop], block.tolist())
+        ))
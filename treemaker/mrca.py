@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#coding=utf-8
+"""
+An index over a built tree that answers most recent common ancestor (MRCA)
+queries in constant time.
+
+Nodes are numbered in depth-first order, parents before children. For two
+nodes u and v with u numbered before v, the MRCA is the parent with the
+lowest number among the parents of the nodes numbered after u up to and
+including v, which is found with a sparse table of range minimums (a
+variant of the Euler tour method that needs one entry per node rather than
+two).
+"""
+__author__ = 'Simon J. Greenhill <simon@simon.net.nz>'
+__copyright__ = 'Copyright (c) 2018 Simon J. Greenhill'
+__license__ = 'New-style BSD'
+
+from array import array
+from operator import attrgetter
+
+from .treemaker import Tree, Traversals
+
+
+class MRCAIndex(object):
+    """
+    Answers questions like "which clade groups these taxa" for a built tree.
+    Building the index takes O(n log n) time and memory for a tree of n
+    nodes, after which `mrca` takes O(1) time and `depth` and
+    `path_to_root` take O(depth).
+
+    >>> index = MRCAIndex(t.tree)
+    >>> index.mrca('B1a', 'B2')
+    <Tree: family b>
+
+    The index describes the tree as it was when the index was built, so
+    build a new one after changing the tree.
+
+    Taxa can be given as labels, which are found like `Tree.get` would, or
+    as nodes of the tree.
+
+    Args:
+        tree (treemaker.Tree): the tree (or a subtree) to index. The nodes
+            of a "compact" tree can also be used.
+
+    Raises:
+        ValueError: from the queries, if a taxon is not in the tree.
+    """
+    def __init__(self, tree):
+        self.tree = tree
+        self._key = id if isinstance(tree, Tree) else attrgetter('id')
+        key = self._key
+        self._nodes = nodes = []
+        self._ids = ids = {}  # node key -> number
+        self._parents = parents = array('i')
+        self._depths = depths = array('i')
+        for node, depth, parent in tree.preorder(detailed=True):
+            ids[key(node)] = len(nodes)
+            parents.append(ids[key(parent)] if depth else -1)
+            depths.append(depth)
+            nodes.append(node)
+
+        # label -> number of the node `get` finds for it
+        self._labels = labels = {}
+        for node in nodes[1:]:
+            if node.node not in labels:
+                labels[node.node] = ids[key(tree.get(node.node))]
+
+        # _table[k][i] is the lowest parent number among nodes i to
+        # i + 2 ** k - 1.
+        self._table = [parents]
+        step = 1
+        while 2 * step < len(nodes):
+            previous = self._table[-1]
+            self._table.append(
+                array('i', map(min, previous[:-step], previous[step:]))
+            )
+            step *= 2
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def _number(self, taxon):
+        """Returns the number of `taxon`, a label or a node"""
+        if isinstance(taxon, Traversals):
+            number = self._ids.get(self._key(taxon))
+        else:
+            number = self._labels.get(taxon)
+        if number is None:
+            raise ValueError("Taxon not found: %s" % taxon)
+        return number
+
+    def _mrca(self, i, j):
+        """Returns the number of the MRCA of the nodes numbered `i` and `j`"""
+        if i == j:
+            return i
+        elif i > j:
+            i, j = j, i
+        k = (j - i).bit_length() - 1
+        row = self._table[k]
+        return min(row[i + 1], row[j - (1 << k) + 1])
+
+    def mrca(self, *taxa):
+        """
+        Returns the most recent common ancestor of `taxa`. For one taxon,
+        that is the taxon itself.
+
+        Args:
+            taxa (str or treemaker.Tree): labels or nodes.
+
+        Returns:
+            treemaker.Tree: the node.
+
+        Raises:
+            ValueError: if no taxa are given, or a taxon is not in the tree.
+        """
+        if not taxa:
+            raise ValueError("No taxa given")
+        # the MRCA of the first and last taxon in depth-first order is also
+        # the MRCA of everything in between.
+        numbers = [self._number(taxon) for taxon in taxa]
+        return self._nodes[self._mrca(min(numbers), max(numbers))]
+
+    def mrca_batch(self, pairs):
+        """
+        Returns the most recent common ancestor of each pair of taxa in
+        `pairs`.
+
+        Args:
+            pairs (iter): (taxon, taxon) pairs of labels or nodes, e.g. a
+                list of tuples or a two-column array.
+
+        Returns:
+            List[treemaker.Tree]: the MRCA of each pair.
+
+        Raises:
+            ValueError: if a taxon is not in the tree.
+        """
+        number, mrca, nodes = self._number, self._mrca, self._nodes
+        return [nodes[mrca(number(a), number(b))] for a, b in pairs]
+
+    def depth(self, taxon):
+        """
+        Returns the number of nodes between `taxon` and the root of the
+        indexed tree, which has a depth of 0.
+
+        Args:
+            taxon (str or treemaker.Tree): a label or node.
+
+        Returns:
+            int: the depth.
+
+        Raises:
+            ValueError: if the taxon is not in the tree.
+        """
+        return self._depths[self._number(taxon)]
+
+    def path_to_root(self, taxon):
+        """
+        Returns the nodes from `taxon` up to the root of the indexed tree.
+
+        Args:
+            taxon (str or treemaker.Tree): a label or node.
+
+        Returns:
+            List[treemaker.Tree]: `taxon`, its parent, and so on to the root.
+
+        Raises:
+            ValueError: if the taxon is not in the tree.
+        """
+        path, i, parents = [], self._number(taxon), self._parents
+        while i != -1:
+            path.append(self._nodes[i])
+            i = parents[i]
+        return path
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+#coding=utf-8
+"""
+Binary snapshots of built trees, so large classifications can be loaded
+without parsing and building them again.
+
+A snapshot is a fixed header followed by a payload::
+
+    header   magic, format version, flags, counts and a CRC-32 of the payload
+    strings  the distinct labels and classification strings, utf-8, joined
+             by NUL bytes
+    labels   int32 string index of the label of each node
+    parents  int32 index of the parent of each node (-1 for the root)
+    added    int32 (taxon, classification, tip) triples: the string indexes
+             of each entry and the index of its tip node (-1 if unknown).
+             Classifications added as tuples of labels are stored joined by
+             PATH_SEPARATOR, with the bits of their index inverted.
+
+Nodes are stored in depth-first order, parents first, with siblings in the
+order they were added, so a node's parent always comes before it. The
+integers are little-endian.
+"""
+__author__ = 'Simon J. Greenhill <simon@simon.net.nz>'
+__copyright__ = 'Copyright (c) 2018 Simon J. Greenhill'
+__license__ = 'New-style BSD'
+
+import os
+import gc
+import sys
+import zlib
+import struct
+from array import array
+from operator import attrgetter
+
+from .treemaker import Tree, TreeMaker, _by_seq, _ordered_dict
+
+MAGIC = b"TMSNAP\r\n"
+FORMAT_VERSION = 3
+HEADER = struct.Struct("<8sHHIIIII")  # magic, version, flags, nnodes,
+                                      # nstrings, strings size, nadded, crc
+NODELABELS, SCOPED, UNAMBIGUOUS = 1, 2, 4
+PATH_SEPARATOR = "\x1f"
+
+
+def _int_array(values=()):
+    return array('i', values)
+
+
+def _to_bytes(values):
+    if sys.byteorder == 'big':
+        values = array('i', values)
+        values.byteswap()
+    if hasattr(values, 'tobytes'):
+        return values.tobytes()
+    return values.tostring()  # python 2.7
+
+
+def _from_bytes(data):
+    values = array('i')
+    if hasattr(values, 'frombytes'):
+        values.frombytes(data)
+    else:  # python 2.7
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        values.fromstring(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def _crc32(view):
+    try:
+        return zlib.crc32(view)
+    except TypeError:  # python 2.7 does not take a memoryview
+        return zlib.crc32(view.tobytes())
+
+
+def _replace(source, target):
+    if hasattr(os, 'replace'):
+        os.replace(source, target)
+        return
+    # python 2.7: os.rename does not overwrite an existing file on windows
+    if os.name == 'nt' and os.path.exists(target):
+        os.unlink(target)
+    os.rename(source, target)
+
+
+def save(maker, filename):
+    """
+    Saves the tree built by `maker` to the snapshot file `filename`. The
+    file is written to a temporary name first and then moved into place.
+
+    Args:
+        maker (treemaker.TreeMaker): the TreeMaker to save.
+        filename (str): the snapshot file.
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: if a label contains a NUL character, or a label in a
+            tuple classification contains PATH_SEPARATOR.
+    """
+    strings, ids = [], {}
+
+    def string_id(value):
+        sid = ids.get(value)
+        if sid is None:
+            if "\0" in value:
+                raise ValueError("Cannot save label with a NUL: %r" % value)
+            sid = ids[value] = len(strings)
+            strings.append(value)
+        return sid
+
+    def classification_id(value):
+        if not isinstance(value, tuple):
+            return string_id(value)
+        for label in value:
+            if PATH_SEPARATOR in label:
+                raise ValueError(
+                    "Cannot save classification label: %r" % label
+                )
+        return ~string_id(PATH_SEPARATOR.join(value))
+
+    root = maker.tree
+    key = _by_seq if isinstance(root, Tree) else attrgetter('id')
+    labels, parents = _int_array(), _int_array()
+    # id of the node added for each entry -> its index
+    tips = dict((id(tip), -1) for tip in maker._added.values()
+                if tip is not None)
+    stack = [(root, -1)]
+    while stack:
+        node, parent = stack.pop()
+        index = len(labels)
+        if id(node) in tips:
+            tips[id(node)] = index
+        labels.append(string_id(node.node))
+        parents.append(parent)
+        children = node.children
+        if children:
+            stack.extend(
+                (child, index)
+                for child in sorted(children, key=key, reverse=True)
+            )
+    added = _int_array()
+    for (leaf, classification), tip in maker._added.items():
+        added.append(string_id(leaf))
+        added.append(classification_id(classification))
+        added.append(-1 if tip is None else tips[id(tip)])
+
+    payload = [
+        "\0".join(strings).encode('utf8'),
+        _to_bytes(labels), _to_bytes(parents), _to_bytes(added),
+    ]
+    crc = 0
+    for chunk in payload:
+        crc = zlib.crc32(chunk, crc)
+    flags = (NODELABELS if root.show_nodelabels else 0) | \
+        (SCOPED if maker.scoped else 0) | \
+        (UNAMBIGUOUS if maker._unambiguous else 0)
+    header = HEADER.pack(
+        MAGIC, FORMAT_VERSION, flags, len(labels), len(strings),
+        len(payload[0]), len(added) // 3, crc & 0xffffffff
+    )
+    tmp = "%s.tmp%d" % (filename, os.getpid())
+    try:
+        with open(tmp, 'wb') as handle:
+            handle.write(header)
+            for chunk in payload:
+                handle.write(chunk)
+        _replace(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+def load(filename, backend="tree"):
+    """
+    Loads a `TreeMaker` from the snapshot file `filename`.
+
+    Args:
+        filename (str): the snapshot file.
+        backend (str): how the tree is stored, see `treemaker.TreeMaker`.
+
+    Returns:
+        treemaker.TreeMaker: a TreeMaker with the saved tree and settings.
+
+    Raises:
+        ValueError: if the file is not a snapshot, was written by an
+            unsupported version, or is corrupt.
+    """
+    with open(filename, 'rb') as handle:
+        data = handle.read()
+    if len(data) < HEADER.size or not data.startswith(MAGIC):
+        raise ValueError("%s is not a treemaker snapshot" % filename)
+    (magic, version, flags, nnodes, nstrings, size, nadded, crc) = \
+        HEADER.unpack_from(data)
+    if version != FORMAT_VERSION:
+        raise ValueError("Unsupported snapshot version %d" % version)
+    payload = memoryview(data)[HEADER.size:]
+    if len(payload) != size + 4 * (2 * nnodes + 3 * nadded) or \
+            _crc32(payload) & 0xffffffff != crc:
+        raise ValueError("Snapshot %s is corrupt" % filename)
+
+    strings = payload[:size].tobytes().decode('utf8').split("\0") \
+        if nstrings else []
+    offset = size
+    labels = _from_bytes(payload[offset:offset + 4 * nnodes])
+    offset += 4 * nnodes
+    parents = _from_bytes(payload[offset:offset + 4 * nnodes])
+    offset += 4 * nnodes
+    added = _from_bytes(payload[offset:offset + 12 * nadded])
+    if len(strings) != nstrings or not nnodes or parents[0] != -1:
+        raise ValueError("Snapshot %s is corrupt" % filename)
+
+    maker = TreeMaker(
+        label=strings[labels[0]], nodelabels=bool(flags & NODELABELS),
+        scoped=bool(flags & SCOPED), backend=backend
+    )
+    collecting = gc.isenabled()
+    gc.disable()  # nothing built here is garbage
+    try:
+        if isinstance(maker.tree, Tree):
+            nodes = _load_tree(maker.tree, strings, labels, parents)
+        else:
+            _load_compact(maker.tree.tree, strings, labels, parents)
+            nodes = None
+        maker._added = _ordered_dict(
+            (
+                (strings[added[i]], _classification(strings, added[i + 1])),
+                _tip(nodes, added[i + 2])
+            )
+            for i in range(0, len(added), 3)
+        )
+        maker._unambiguous = bool(flags & UNAMBIGUOUS) and backend == 'tree'
+    except IndexError:
+        raise ValueError("Snapshot %s is corrupt" % filename)
+    finally:
+        if collecting:
+            gc.enable()
+    return maker
+
+
+def _load_tree(root, strings, labels, parents):
+    nodes = [root]
+    append = nodes.append
+    for index in range(1, len(labels)):
+        parent = parents[index]
+        if not 0 <= parent < index:
+            raise IndexError("parent %d of node %d" % (parent, index))
+        append(nodes[parent]._attach(Tree(strings[labels[index]])))
+    root._reindex()
+    return nodes
+
+
+def _load_compact(tree, strings, labels, parents):
+    for index in range(1, len(labels)):
+        parent = parents[index]
+        if not 0 <= parent < index:
+            raise IndexError("parent %d of node %d" % (parent, index))
+        tree.add(parent, strings[labels[index]])
+
+
+def _classification(strings, index):
+    """Returns the classification of an entry stored at `index`"""
+    if index >= 0:
+        return strings[index]
+    path = strings[~index]
+    return tuple(path.split(PATH_SEPARATOR)) if path else ()
+
+
+def _tip(nodes, index):
+    """Returns the node of an entry stored at `index`, or None"""
+    if nodes is None or index == -1:
+        return None
+    if not 0 <= index < len(nodes):
+        raise IndexError("tip %d" % index)
+    return nodes[index]
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#coding=utf-8
+"""Counters and phase timings for TreeMaker runs"""
+__author__ = 'Simon J. Greenhill <simon@simon.net.nz>'
+__copyright__ = 'Copyright (c) 2018 Simon J. Greenhill'
+__license__ = 'New-style BSD'
+
+import sys
+from contextlib import contextmanager
+from timeit import default_timer as timer
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+def peak_memory():
+    """
+    Returns the peak resident memory of this process in bytes, or None if
+    it cannot be measured on this platform.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Stats(object):
+    """
+    Counters and phase timings collected by a `TreeMaker`.
+
+    Attributes:
+        lines_parsed (int): lines read from classification files.
+        nodes_created (int): nodes added to the tree (clades and taxa).
+        lookups (int): searches for an existing clade node made while adding
+            rows. Calls to `Tree.get` from other code are not counted.
+        fragments_written (int): pieces of Newick text streamed out by
+            `write_to_handle` or `write_to_file`: one per tip, one per clade
+            written out from its children, and one per clade written from
+            its cached fragment (see `Tree.newick`). Clades with a single
+            child are collapsed, so are not counted, and `write` is not
+            counted at all. This is a measure of the work done writing
+            rather than of the size of the tree.
+        cache_hits (int): reads answered from a `treemaker.cache.BuildCache`.
+        cache_misses (int): reads that were not.
+        phases (list): (name, seconds, peak memory in bytes or None) for each
+            phase timed with `phase`.
+    """
+    COUNTERS = (
+        'lines_parsed', 'nodes_created', 'lookups', 'fragments_written',
+        'cache_hits', 'cache_misses',
+    )
+
+    def __init__(self):
+        self.lines_parsed = 0
+        self.nodes_created = 0
+        self.lookups = 0
+        self.fragments_written = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Times the code in a `with` block as the phase `name`:
+
+        >>> with t.stats.phase("read"):
+        >>>     t.read(filename)
+        """
+        start = timer()
+        try:
+            yield
+        finally:
+            self.phases.append((name, timer() - start, peak_memory()))
+
+    def as_dict(self):
+        """
+        Returns the counters and phases as a dictionary, e.g. for logging.
+
+        Returns:
+            dict: counter name -> value, and "phases" -> list of dicts.
+        """
+        out = dict((name, getattr(self, name)) for name in self.COUNTERS)
+        out['phases'] = [
+            {'name': name, 'seconds': seconds, 'peak_memory': memory}
+            for name, seconds, memory in self.phases
+        ]
+        return out
+
+    def report(self, handle=None):
+        """
+        Writes a summary table to `handle` (default: `sys.stderr`).
+
+        Args:
+            handle (file): a file-like object opened for writing text.
+
+        Returns:
+            None
+        """
+        handle = sys.stderr if handle is None else handle
+        handle.write("%-12s %10s %14s\n" % ('phase', 'time (s)', 'peak mem (MB)'))
+        for name, seconds, memory in self.phases:
+            memory = '-' if memory is None else '%.1f' % (memory / 1048576.0)
+            handle.write("%-12s %10.3f %14s\n" % (name, seconds, memory))
+        width = max(len(name) for name in self.COUNTERS)
+        for name in self.COUNTERS:
+            handle.write("%-*s %d\n" % (width, name, getattr(self, name)))
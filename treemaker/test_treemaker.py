@@ -1,9 +1,25 @@
+from __future__ import absolute_import
 import os
+import sys
 import unittest
 from tempfile import mkdtemp
 from shutil import rmtree
+from io import BytesIO
+try:
+    from StringIO import StringIO  # python 2.7 writes byte strings
+except ImportError:
+    from io import StringIO
 
-from treemaker import Tree, TreeMaker, parse_args
+from treemaker import Tree, TreeMaker, Stats, parse_args, parse_options
+from treemaker.treemaker import _split_file, _mmap_rows, _run_batch
+from treemaker.compact import CompactTree
+from treemaker.cache import BuildCache
+from treemaker.mrca import MRCAIndex
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class Test_Tree(unittest.TestCase):
     
@@ -100,6 +116,28 @@ class Test_Tree(unittest.TestCase):
         t.get("B").add("sub", ["b1", "b2"])
         assert list([t.node for t in t.tips()]) == ['A', 'b1', 'b2']
     
+    def test_children_are_sorted(self):
+        t = Tree('root', ['C', 'A', 'B'])
+        t.add('AA')
+        assert [c.node for c in t.children] == ['A', 'AA', 'B', 'C']
+    
+    def test_children_sorted_ties_keep_insertion_order(self):
+        t = Tree('root', ['b'])
+        first = t.add('a')
+        second = t.add('a', ['x', 'y'])
+        t.add('0')
+        assert [c.node for c in t.children] == ['0', 'a', 'a', 'b']
+        assert t.children[1] is first and t.children[2] is second
+        assert str(t) == "(0,a,(x,y),b)"
+        # lookups still follow the order nodes were added in
+        assert t.get('a') is first
+    
+    def test_tips_are_sorted(self):
+        t = Tree('root', ['Z', 'B'])
+        t.get("B").add("sub", ["b2", "b1"])
+        t.add('A')
+        assert [t.node for t in t.tips()] == ['A', 'b1', 'b2', 'Z']
+    
     def test_conflicts(self):
         t = Tree('root', ['A', 'B'])
         t.get("A").add("sub", ["b1", "b2"])
@@ -132,15 +170,294 @@ class Test_Tree(unittest.TestCase):
         t.get("B").add('b1')
         assert str(t) == "(A,b1,(c1,c2))"
     
+    def test_get_child(self):
+        t = Tree('root', ['A', 'B'])
+        t.get('A').add('sub')
+        assert t.get_child('B') is t.get('B')
+        assert t.get_child('sub') is None
+        assert t.get('A').get_child('sub') is t.get('sub')
+    
+    def test_get_or_create_scoped(self):
+        t = Tree('root', ['A'])
+        sub = t.get('A').add('sub')
+        assert t.get_or_create('sub') is sub
+        scoped = t.get_or_create('sub', scoped=True)
+        assert scoped is not sub
+        assert scoped.parent is t
+        assert t.get_or_create('sub', scoped=True) is scoped
+    
     def test_deep_tree(self):
         t = Tree('root')
         taxon = t
         for i in range(0, 10):
             taxon = taxon.add(i, [i])
         assert str(t) == "(0,(1,(2,(3,(4,(5,(6,(7,(8,9)))))))))"
+    
+    def test_newick_cache(self):
+        t = Tree('root', ['A', 'B'])
+        sub = t.get("B").add("sub", ["b1", "b2"])
+        assert str(t) == "(A,(b1,b2))"
+        assert sub._newick == "(b1,b2)"
+        sub.add("b3")
+        assert t._newick is None  # ancestors were invalidated
+        assert str(t) == "(A,(b1,b2,b3))"
+        t.get('b1').add('deep1')
+        t.get('b1').add('deep2')
+        assert str(t) == "(A,((deep1,deep2),b2,b3))"
+    
+    def test_newick_cache_and_nodelabels(self):
+        t = Tree('root', ['A', 'B'])
+        assert str(t) == "(A,B)"
+        t.show_nodelabels = True
+        assert str(t) == "(A,B)root"
+        other = Tree('sub', ['x', 'y'])
+        assert str(other) == "(x,y)"
+        t.add(other)
+        assert str(t) == "(A,B,(x,y)sub)root"
+    
+    def test_very_deep_tree(self):
+        # deeper than the default recursion limit
+        depth = sys.getrecursionlimit() + 100
+        t = Tree('root')
+        taxon = t
+        for i in range(0, depth):
+            taxon = taxon.add(i, [i])
+        newick = str(t)
+        assert newick.startswith("(0,(1,(2,")
+        assert newick.count(",") == depth - 1
+        assert newick.count("(") == newick.count(")") == depth - 1
+    
+    def test_newick(self):
+        t = Tree('root', ['A', 'B'])
+        t.get("B").add("sub", ["b1", "b2"])
+        assert t.newick() == str(t) == "(A,(b1,b2))"
+        assert t.get("sub").newick() == "(b1,b2)"
+        assert t.get("B").newick() == "(b1,b2)"
+        assert t.get("A").newick() == "A"
+    
+    def test_get_returns_first_match(self):
+        # depth first: the "x" below "a" is found before the later child "x"
+        t = Tree('root', ['a'])
+        t.get('a').add('x', ['deep'])
+        shallow = t.add('x')
+        assert t.get('x') is t.get('a').get('x')
+        assert t.get('x') is not shallow
+        # ... but an earlier branch wins even if it was extended later.
+        t = Tree('root', ['a', 'b'])
+        later = t.get('b').add('x')
+        earlier = t.get('a').add('x')
+        assert t.get('x') is earlier
+        assert t.get('b').get('x') is later
+    
+    def test_get_missing(self):
+        t = Tree('root', ['A', 'B'])
+        assert t.get('C') is None
+        assert t.get('root') is None
+        assert t.get('A').get('B') is None
+    
+    def test_detach(self):
+        t = Tree('root', ['a', 'b'])
+        first = t.get('a').add('x', ['deep'])
+        second = t.get('b').add('x')
+        t.add('x')
+        t.get('a')._detach(first)
+        assert first.parent is None
+        assert t.get('x') is second
+        assert t.get('deep') is None
+        assert t.get('a').get_child('x') is None
+        assert str(t) == "(a,x,x)"
+        # the first child with a label is replaced by the next one
+        t.get('b').add('x')
+        t.get('b')._detach(second)
+        assert t.get('b').get_child('x') is t.get('b').children[0]
+
+    def test_remove(self):
+        t = Tree('root', ['a', 'b'])
+        t.get('a').add('sub').add('x')
+        removed = t.remove('x')
+        assert removed.node == 'x' and removed.parent is None
+        assert str(t) == "(sub,b)"
+        assert t.get('x') is None
+        # prune removes the ancestors left empty, but not this node
+        a = t.get('a')
+        t.get('sub').add('y')
+        assert t.remove(t.get('y'), prune=True) is a
+        assert str(t) == "b"
+        assert t.get('a') is None and t.get('sub') is None
+        for node in ['missing', t, Tree('b')]:
+            with self.assertRaises(ValueError):
+                t.remove(node)
+
+    def test_remove_from_wide_family(self):
+        t = Tree('root')
+        family = t.add('family', [str(i) for i in range(20000)])
+        first = family.add('sub', ['x'])
+        second = family.add('sub', ['x'])
+        # only the children with children of their own are searched for
+        # the next match, in the order they were added
+        assert len(family._inner) == 2
+        assert family._inner[0] is first and family._inner[1] is second
+        for i in range(0, 20000, 2):
+            t.remove(str(i))
+        assert len(family.children) == 10002
+        assert t.get('1') is family.get_child('1')
+        assert t.remove(first.get('x'), prune=True) is first
+        assert t.get('x') is second.get('x') and t.get('sub') is second
+        assert family._inner[0] is second and len(family._inner) == 1
+        t.remove(second.get('x'))
+        assert family._inner is None and t.get('x') is None
+
+    def test_move(self):
+        t = Tree('root', ['a', 'b'])
+        x = t.get('a').add('x', ['deep'])
+        t.get('b').add('x')
+        moved = t.move(x, t.get('b'))
+        assert moved is x and x.parent is t.get('b')
+        assert str(t) == "(a,(x,deep))"
+        # the moved node was added last, so the other "x" is found first
+        assert t.get('x') is t.get('b').children[0]
+        assert t.get('b').get_child('x') is not x
+        assert t.get('deep') is x.children[0]
+        assert t.get('a').get('deep') is None
+        t.move(t.get('b'), t.get('a'))
+        assert str(t) == "(x,deep)"
+        assert t.get('deep').parent.parent.parent is t.get('a')
+        for node, new_parent in [
+            (t, t.get('a')),  # the root
+            (t.get('a'), t.get('deep')),  # below itself
+            (t.get('b'), Tree('elsewhere')),  # another tree
+        ]:
+            with self.assertRaises(ValueError):
+                t.move(node, new_parent)
+
+    def test_subset(self):
+        t = Tree('root', ['a', 'b', 'c'])
+        t.get('a').add('sub', ['a1', 'a2'])
+        t.get('b').add('b1')
+        t.get('b').add('b2')
+        t.get('c').add('c1')
+        before = str(t)
+        assert str(t.subset(['a1', 'b1', 'b2'])) == "(a1,(b1,b2))"
+        assert str(t.subset(['a1', 'a2', 'c1'])) == "((a1,a2),c1)"
+        # clades with a single child are kept, and collapsed in the output
+        sub = t.subset(['a1', t.get('b2'), 'c1', 'c1'])
+        assert str(sub) == "(a1,b2,c1)"
+        assert sub.get('a1').parent.parent is sub.get('a')
+        assert sub.get('a2') is None
+        assert str(t.subset([])) == "root"
+        assert str(t) == before
+        # a subset of a subtree
+        assert str(t.get('a').subset(['a2'])) == "a2"
+        with self.assertRaises(ValueError):
+            t.subset(['missing'])
+        with self.assertRaises(ValueError):
+            t.get('a').subset([t.get('b1')])
+
+    def test_subset_keeps_order_and_nodelabels(self):
+        t = Tree('root', show_nodelabels=True)
+        first = t.add('x', ['p', 'q'])
+        second = t.add('x', ['r', 's'])
+        sub = t.subset([second.get('s'), second.get('r'), first.get('p'), 'q'])
+        assert str(sub) == "((p,q)x,(r,s)x)root"
+        assert sub.get('x').get('p') is not None
+
+    def test_subset_ambiguous_label(self):
+        rows = [('A', 'x, y'), ('A2', 'x'), ('B', 'y'), ('C', 'w')]
+        t = TreeMaker()
+        [t.add(*row) for row in rows]
+        # B was attached below x/y, and stays there in the subset
+        sub = t.tree.subset(['B', 'A2', 'C'])
+        assert str(sub) == "(C,(A2,B))"
+        assert sub.get('B').parent.parent is sub.get('x')
+        # ... whereas building from these rows alone puts y at the root
+        fresh = TreeMaker()
+        [fresh.add(*row) for row in rows[1:]]
+        assert str(fresh.tree) == "(C,A2,B)"
+        # scoped builds never look past the direct children, so match
+        scoped, fresh = TreeMaker(scoped=True), TreeMaker(scoped=True)
+        [scoped.add(*row) for row in rows]
+        [fresh.add(*row) for row in rows[1:]]
+        assert str(scoped.tree.subset(['B', 'A2', 'C'])) == str(fresh.tree)
+    
+    def test_get_from_added_subtree(self):
+        sub = Tree('sub', ['b1', 'b2'])
+        sub.get('b1').add('b1a')
+        t = Tree('root', ['A'])
+        t.add(sub)
+        assert t.get('sub') is sub
+        assert t.get('b1a') is sub.get('b1a')
+        assert t.get('b1a').parent.parent is sub
         
 
 
+class Test_Traversals(unittest.TestCase):
+    def setUp(self):
+        self.t = Tree('root', ['A', 'B'])
+        self.t.get("B").add("sub", ["b1", "b2"])
+        self.t.add("C")
+    
+    def test_preorder(self):
+        assert [n.node for n in self.t.preorder()] == [
+            'root', 'A', 'B', 'sub', 'b1', 'b2', 'C'
+        ]
+    
+    def test_postorder(self):
+        assert [n.node for n in self.t.postorder()] == [
+            'A', 'b1', 'b2', 'sub', 'B', 'C', 'root'
+        ]
+    
+    def test_levelorder(self):
+        assert [n.node for n in self.t.levelorder()] == [
+            'root', 'A', 'B', 'C', 'sub', 'b1', 'b2'
+        ]
+    
+    def test_tips(self):
+        assert [n.node for n in self.t.tips()] == ['A', 'b1', 'b2', 'C']
+        assert [n.node for n in self.t.get('B').tips()] == ['b1', 'b2']
+        assert list(self.t.get('A').tips()) == []
+    
+    def test_detailed(self):
+        detailed = [
+            (n.node, depth, p.node if p else None)
+            for (n, depth, p) in self.t.preorder(detailed=True)
+        ]
+        assert detailed[0] == ('root', 0, None)
+        assert detailed[3] == ('sub', 2, 'B')
+        assert [(n.node, d) for (n, d, p) in self.t.tips(detailed=True)] == [
+            ('A', 1), ('b1', 3), ('b2', 3), ('C', 1)
+        ]
+        assert [d for (n, d, p) in self.t.postorder(detailed=True)] == [
+            1, 3, 3, 2, 1, 1, 0
+        ]
+        assert [d for (n, d, p) in self.t.levelorder(detailed=True)] == [
+            0, 1, 1, 1, 2, 3, 3
+        ]
+    
+    def test_from_subtree(self):
+        sub = self.t.get('B')
+        assert [n.node for n in sub.preorder()] == ['B', 'sub', 'b1', 'b2']
+        assert [(n.node, d, p.node) for (n, d, p) in sub.preorder(True)][0] \
+            == ('B', 0, 'root')
+    
+    def test_very_deep_tree(self):
+        t = Tree('root')
+        taxon = t
+        for i in range(0, sys.getrecursionlimit() + 100):
+            taxon = taxon.add(i)
+        assert len(list(t.preorder())) == sys.getrecursionlimit() + 101
+        assert len(list(t.postorder())) == sys.getrecursionlimit() + 101
+        assert len(list(t.tips())) == 1
+    
+    def test_compact(self):
+        t = CompactTree('root').root
+        t.add('A')
+        t.add('B').add("sub", ["b1", "b2"])
+        t.add("C")
+        for order in ('preorder', 'postorder', 'levelorder', 'tips'):
+            assert [n.node for n in getattr(t, order)()] == \
+                [n.node for n in getattr(self.t, order)()]
+
+
 class Test_Tree_Nodelabels(unittest.TestCase):
     def test_simple(self):
         t = Tree('root', ['A', 'B', 'C'], show_nodelabels=True)
@@ -189,6 +506,26 @@ class Test_Tree_Nodelabels(unittest.TestCase):
         b2.add("B2")
         assert str(t) == '((A1,A2)family a,((B1a,B1b)subgroup 1,B2)family b)root'
     
+    def test_setting_is_held_by_root(self):
+        t = Tree('root', ['A'], show_nodelabels=True)
+        sub = t.add(Tree('sub', ['b1', 'b2']))  # sub has its own setting
+        assert sub.show_nodelabels
+        assert str(t) == "(A,(b1,b2)sub)root"
+        sub.show_nodelabels = False
+        assert t.show_nodelabels is False
+        assert str(t) == "(A,(b1,b2))"
+    
+    def test_slots(self):
+        t = Tree('root', ['A'])
+        assert not hasattr(t, '__dict__')
+        assert not hasattr(t.get('A'), '__dict__')
+    
+    def test_labels_are_interned(self):
+        t = Tree('root')
+        a = t.add("".join(['family', ' a'])).add("".join(['sub', 'group']))
+        b = t.add("".join(['family', ' b'])).add("".join(['sub', 'group']))
+        assert a.node is b.node
+    
     def test_deep_tree(self):
         t = Tree('root', show_nodelabels=True)
         taxon = t
@@ -213,6 +550,20 @@ class Test_TreeMaker(unittest.TestCase):
         assert t.parse_classification("family a, subgroup 1") == [
             'family a', 'subgroup 1'
         ]
+        assert t.parse_classification(('a, b', 'c')) == ['a, b', 'c']
+    
+    def test_add_path(self):
+        t = TreeMaker()
+        t.add('A', ('a',))
+        t.add('AB1', ['a', 'b'])
+        t.add('AB2', 'a, b')
+        assert t.write() == "(A,(AB1,AB2));"
+        with self.assertRaises(ValueError):
+            t.add('AB1', ('a', 'b'))  # duplicate
+        t.apply_changes(added=[('C', ['c'])], removed=[('AB1', ['a', 'b'])])
+        assert t.write() == "((A,AB2),C);"
+        t.remove('C', ('c',))
+        assert t.write() == "(A,AB2);"
     
     def test_add(self):
         t = TreeMaker()
@@ -252,12 +603,401 @@ class Test_TreeMaker(unittest.TestCase):
         with self.assertRaises(ValueError):
             t = TreeMaker().add_from(taxa)
 
+    def test_add_from_bulk(self):
+        taxa = [
+            ('A1', 'family a, subgroup 1'),
+            ('A2', 'family a, subgroup 2'),
+            ('B1a', 'family b, subgroup 1'),
+            ('B1b', 'family b, subgroup 1'),
+            ('B2', 'family b, subgroup 2'),
+        ]
+        for scoped in (False, True):
+            t = TreeMaker(scoped=scoped)
+            t.add_from(taxa, bulk=True)
+            assert str(t.tree) == "((A1,A2),((B1a,B1b),B2))"
+            assert t.tree.get('family b').get('B1a').node == 'B1a'
+    
+    def test_add_from_bulk_matches_rows(self):
+        # later rows change which node earlier classifications resolve to
+        taxa = [
+            ('t0', 'A'), ('t1', 'B, x'), ('t2', 'x'), ('t3', 'A, x'),
+            ('t4', 'x'), ('x', 'B'), ('t5', 'B, x, y'), ('t6', 'x, y'),
+        ]
+        for scoped in (False, True):
+            expected = TreeMaker(scoped=scoped, nodelabels=True)
+            expected.add_from(taxa)
+            t = TreeMaker(scoped=scoped, nodelabels=True)
+            t.add_from(taxa, bulk=True)
+            assert str(t.tree) == str(expected.tree)
+    
+    def test_add_from_bulk_exception(self):
+        t = TreeMaker()
+        with self.assertRaises(ValueError):
+            t.add_from([('A1', 'a'), ('A2a'), ('B1', 'b')], bulk=True)
+        with self.assertRaises(ValueError):
+            t.add_from([('A1', 'a'), ('A(', 'a')], bulk=True)
+        with self.assertRaises(ValueError):
+            t.add_from([('A1', 'a'), ('A1', 'a')], bulk=True)
+        # nothing was added
+        assert str(t.tree) == "root"
+        t.add('A1', 'a')
+        with self.assertRaises(ValueError):
+            t.add_from([('A1', 'a')], bulk=True)
+    
+    def test_add_from_bulk_exception_on_bad_label(self):
+        for scoped in (False, True):
+            t = TreeMaker(scoped=scoped)
+            t.add('A', 'x, y')
+            with self.assertRaises(ValueError):
+                t.add_from([('B', 'x, z'), ('C', 'y;z')], bulk=True)
+            assert t.write() == "A;" and list(t._added) == [('A', 'x, y')]
+            assert t.tree.get('A') is not None and t.tree.get('x') is not None
+        # the first error is the one adding the entries in turn gives
+        rows = [('a', 'x;'), ('b(', 'y')]
+        errors = []
+        for bulk in (False, True):
+            with self.assertRaises(ValueError) as error:
+                TreeMaker().add_from(rows, bulk=bulk)
+            errors.append(str(error.exception))
+        assert errors[0] == errors[1] == "Forbidden character ';' node: x;"
+    
     def test_error_on_duplicate(self):
         t = TreeMaker()
         t.add('A', 'a')
         with self.assertRaises(ValueError):
             t.add('A', 'a')
 
+    def test_add_scoped(self):
+        t = TreeMaker(scoped=True)
+        t.add('A1', 'family a, subgroup 1')
+        t.add('A2', 'family a, subgroup 2')
+        t.add('B1a', 'family b, subgroup 1')
+        t.add('B1b', 'family b, subgroup 1')
+        t.add('B2', 'family b, subgroup 2')
+        assert str(t.tree) == "((A1,A2),((B1a,B1b),B2))"
+
+    def test_add_scoped_no_deep_match(self):
+        # unscoped, "c" is found below "b"; scoped it is a new child of "a"
+        rows = [('X', 'a, b, c'), ('Y', 'a, b, z'), ('Z', 'a, c')]
+        assert str(TreeMaker().add_from(rows)) == "((X,Z),Y)"
+        assert str(TreeMaker(scoped=True).add_from(rows)) == "((X,Y),Z)"
+    
+    def test_stats(self):
+        rows = [('A1', 'a, b'), ('A2', 'a, b'), ('C', 'c')]
+        for bulk in (False, True):
+            t = TreeMaker()
+            t.add_from(rows, bulk=bulk)
+            assert t.stats.nodes_created == 6  # a, b, c and three taxa
+            assert t.stats.lookups == (3 if bulk else 5)
+            handle = StringIO()
+            t.write_to_handle(handle)
+            # the three taxa, "b" and the root; "a" has a single child so
+            # is collapsed into "b"
+            assert t.stats.fragments_written == 5
+            # the cached fragment of the whole tree is one piece
+            t.write()
+            t.write_to_handle(handle)
+            assert t.stats.fragments_written == 6
+            t.tree.get('a').get('b')
+            assert t.stats.lookups == (3 if bulk else 5)
+            assert t.stats.lines_parsed == 0
+
+
+class Test_Stats(unittest.TestCase):
+    def test_phase(self):
+        stats = Stats()
+        with stats.phase("read"):
+            stats.lines_parsed += 2
+        name, seconds, memory = stats.phases[0]
+        assert name == "read" and seconds >= 0
+        assert memory is None or memory > 0
+        assert stats.as_dict()['lines_parsed'] == 2
+        assert stats.as_dict()['phases'][0]['name'] == "read"
+    
+    def test_report(self):
+        stats = Stats()
+        with stats.phase("build"):
+            stats.nodes_created = 3
+        handle = StringIO()
+        stats.report(handle)
+        report = handle.getvalue()
+        assert report.splitlines()[1].startswith("build")
+        # the counts line up after the longest counter name
+        counters = report.splitlines()[2:]
+        assert len(counters) == len(Stats.COUNTERS)
+        assert set(line.rindex(" ") for line in counters) == \
+            set([len("fragments_written")])
+        assert "nodes_created     3" in report
+
+
+class Test_ApplyChanges(unittest.TestCase):
+    rows = [
+        ('A1', 'family a, subgroup 1'),
+        ('A2', 'family a, subgroup 2'),
+        ('B1a', 'family b, subgroup 1'),
+        ('B1b', 'family b, subgroup 1'),
+        ('B2', 'family b, subgroup 2'),
+        ('C', 'family c'),
+    ]
+    
+    def _check(self, t, added, removed, rows=None, **kwargs):
+        t.apply_changes(added=added, removed=removed)
+        fresh = TreeMaker(**kwargs)
+        rows = self.rows if rows is None else rows
+        fresh.add_from([r for r in rows if r not in removed] + added)
+        assert t.write() == fresh.write()
+        return fresh
+    
+    def test_move_and_prune(self):
+        for scoped in (False, True):
+            t = TreeMaker(scoped=scoped, nodelabels=True)
+            t.add_from(self.rows)
+            assert t._unambiguous
+            self._check(
+                t, added=[('A2', 'family b, subgroup 2'), ('D', 'family d')],
+                removed=[('A2', 'family a, subgroup 2'), ('C', 'family c')],
+                scoped=scoped, nodelabels=True
+            )
+            assert t._unambiguous
+            assert t.tree.get('family c') is None
+            assert t.tree.get('subgroup 2').parent.node == 'family b'
+            with self.assertRaises(ValueError):
+                t.add('A2', 'family b, subgroup 2')
+            t.add('A2', 'family a, subgroup 2')  # no longer a duplicate
+    
+    def test_ambiguous_rebuilds(self):
+        # "C" is both a taxon and a family, so the order of the rows matters
+        rows = self.rows + [('X', 'C')]
+        t = TreeMaker()
+        t.add_from(rows)
+        assert not t._unambiguous
+        self._check(t, added=[('Y', 'C')], removed=[('C', 'family c')], rows=rows)
+        # ... and an addition that makes it ambiguous also rebuilds it
+        t = TreeMaker()
+        t.add_from(self.rows)
+        self._check(t, added=[('x', 'subgroup 1')], removed=[])
+        assert not t._unambiguous
+    
+    def test_compact(self):
+        t = TreeMaker(backend="compact")
+        t.add_from(self.rows)
+        self._check(
+            t, added=[('E', 'family a')], removed=[('B2', 'family b, subgroup 2')],
+            backend="compact"
+        )
+    
+    def test_errors_leave_tree_unchanged(self):
+        t = TreeMaker()
+        t.add_from(self.rows)
+        expected = t.write()
+        for added, removed in [
+            ([], [('A1', 'family b')]),  # not added
+            ([('A1', 'family a, subgroup 1')], []),  # duplicate
+            ([('D', 'd'), ('D', 'd')], []),
+            ([('D;', 'd')], [('C', 'family c')]),
+            ([('D', 'd')], [('C', 'family c'), ('C', 'family c')]),
+            ([('D',)], []),
+        ]:
+            with self.assertRaises(ValueError):
+                t.apply_changes(added=added, removed=removed)
+            assert t.write() == expected
+    
+    def test_remove(self):
+        t = TreeMaker(nodelabels=True)
+        t.add_from(self.rows)
+        t.remove('C', 'family c')
+        fresh = TreeMaker(nodelabels=True)
+        fresh.add_from(self.rows[:-1])
+        assert t.write() == fresh.write()
+        assert t._unambiguous and t.tree.get('family c') is None
+        with self.assertRaises(ValueError):
+            t.remove('C', 'family c')
+        # without pruning the empty clade is left, written as a taxon
+        t.remove('A1', 'family a, subgroup 1', prune=False)
+        assert t.tree.get('family a').get_child('subgroup 1').is_tip
+        assert not t._unambiguous
+        
+        # the compact backend is rebuilt
+        compact = TreeMaker(nodelabels=True, backend="compact")
+        compact.add_from(self.rows)
+        compact.remove('C', 'family c')
+        assert compact.write() == fresh.write()
+        with self.assertRaises(ValueError):
+            compact.remove('C', 'family c')
+    
+    def test_remove_ambiguous(self):
+        # "X" is added below the taxon "C"
+        t = TreeMaker()
+        t.add_from(self.rows + [('X', 'C')])
+        assert t.tree.get('X').parent is t.tree.get('C')
+        with self.assertRaises(ValueError):
+            t.remove('C', 'family c', prune=False)
+        t.remove('X', 'C', prune=False)
+        fresh = TreeMaker()
+        fresh.add_from(self.rows)
+        assert t.write() == fresh.write()
+        tree = t.tree
+        t.remove('C', 'family c')  # "family c" was made for "C" alone
+        assert t.tree is tree
+        fresh = TreeMaker()
+        fresh.add_from(self.rows[:-1])
+        assert t.write() == fresh.write()
+    
+    def test_remove_ambiguous_in_place(self):
+        rows = [
+            ('A', 'f, g, x'), ('B', 'f, h'), ('C', 'f, h, x'), ('D', 'f, x'),
+            ('E', 'x, y'), ('F', 'f, x, z'),
+        ]
+        for row in rows:
+            t = TreeMaker()
+            t.add_from(rows)
+            assert not t._unambiguous
+            tree = t.tree
+            t.remove(*row)
+            fresh = TreeMaker()
+            fresh.add_from([r for r in rows if r != row])
+            assert t.write() == fresh.write()
+            # "g, x" and "h" were made for "A" and "B" but later entries
+            # were added to them, so those need a rebuild
+            assert (t.tree is tree) == (row[0] not in ('A', 'B'))
+    
+    def test_update(self):
+        tmpdir = mkdtemp()
+        try:
+            old, new = os.path.join(tmpdir, 'old'), os.path.join(tmpdir, 'new')
+            with open(old, 'w') as handle:
+                handle.write('A   a, b\nB   a, c\nC   d\nD   d, e\n')
+            with open(new, 'w') as handle:
+                handle.write('A   a, b\nE   d, e\nC   a, c\nD   d, e\n')
+            t = TreeMaker()
+            t.read(old)
+            t.update(old, new)
+            fresh = TreeMaker()
+            fresh.read(new)
+            assert t.write() == fresh.write() == "((A,C),(D,E));"
+        finally:
+            rmtree(tmpdir)
+
+
+class Test_CompactTree(unittest.TestCase):
+    def setUp(self):
+        self.tree = CompactTree('root')
+        self.root = self.tree.root
+    
+    def test_simple(self):
+        [self.root.add(label) for label in ['C', 'A', 'B']]
+        assert str(self.root) == "(A,B,C)"
+        assert len(self.tree) == 4
+    
+    def test_children_sorted_once(self):
+        tree = self.tree
+        [self.root.add(label) for label in ['A', 'B', 'B']]
+        assert not tree._unsorted[0]  # added in order, so never sorted
+        self.root.add('A')
+        assert tree._unsorted[0]
+        assert [tree.labels[tree.label[c]] for c in tree.children(0)] == \
+            ['A', 'A', 'B', 'B']
+        # the chain is now linked in label order, ties in the order added
+        assert not tree._unsorted[0]
+        assert tree.children(0) == [1, 4, 2, 3]
+        assert tree.get_child(0, 'A') == 1
+        self.root.add('C')
+        assert not tree._unsorted[0] and str(self.root) == "(A,A,B,B,C)"
+
+    def test_nodelabels(self):
+        t = CompactTree('root', show_nodelabels=True).root
+        t.add('A')
+        t.add('B').add("sub", ["b1", "b2"])
+        assert str(t) == "(A,(b1,b2)sub)root"
+    
+    def test_labels_are_interned(self):
+        self.root.add('A').add("sub", ["x"])
+        self.root.add('B').add("sub", ["y"])
+        assert self.tree.labels.count("sub") == 1
+        assert str(self.root) == "(x,y)"
+    
+    def test_get(self):
+        a = self.root.add('a')
+        later = self.root.add('b').add('x')
+        earlier = a.add('x')
+        assert self.root.get('x').id == earlier.id
+        assert self.root.get('b').get('x').id == later.id
+        assert self.root.get('missing') is None
+        assert a.get('a') is None
+    
+    def test_get_indexed(self):
+        # more nodes labelled 'x' than INDEX_THRESHOLD, added out of
+        # depth-first order
+        expected = Tree('root')
+        groups = [self.root.add('g%d' % i) for i in range(12)]
+        [expected.add('g%d' % i) for i in range(12)]
+        for i in range(40):
+            group = 'g%d' % ((i * 5) % 12)
+            self.root.get(group).add('x').add('x%d' % i)
+            expected.get(group).add('x').add('x%d' % i)
+        assert self.tree._indexed[self.tree._label_ids['x']]
+        assert self.root.get('x').children[0].node == \
+            expected.get('x').children[0].node
+        for group in groups:
+            assert group.get('x').children[0].node == \
+                expected.get(group.node).get('x').children[0].node
+    
+    def test_get_child(self):
+        self.root.add('a').add('x')
+        assert self.root.get_child('x') is None
+        assert self.root.get_child('a').get_child('x').node == 'x'
+    
+    def test_tips(self):
+        self.root.add('A')
+        self.root.add('B').add("sub", ["b1", "b2"])
+        assert [t.node for t in self.root.tips()] == ['A', 'b1', 'b2']
+        assert self.root.get('A').is_tip
+        assert self.root.get('sub').is_node
+        assert self.root.get('sub').parent.node == 'B'
+    
+    def test_children_are_sorted(self):
+        [self.root.add(label) for label in ['C', 'A', 'B', 'A']]
+        assert [c.node for c in self.root.children] == ['A', 'A', 'B', 'C']
+        assert [c.id for c in self.root.children] == [2, 4, 3, 1]
+    
+    def test_add_tree(self):
+        self.root.add(Tree('sub', ['b1', 'b2']))
+        self.root.add('A')
+        assert str(self.root) == "(A,(b1,b2))"
+    
+    def test_sanitise(self):
+        with self.assertRaises(ValueError):
+            self.root.add('a;')
+    
+    def test_deep_tree(self):
+        taxon = self.root
+        for i in range(0, 10):
+            taxon = taxon.add(i, [i])
+        assert str(self.root) == "(0,(1,(2,(3,(4,(5,(6,(7,(8,9)))))))))"
+    
+    def test_treemaker_backend(self):
+        rows = [
+            ('A1', 'family a, subgroup 1'),
+            ('A2', 'family a, subgroup 2'),
+            ('B1a', 'family b, subgroup 1'),
+            ('B1b', 'family b, subgroup 1'),
+            ('B2', 'family b, subgroup 2'),
+            ('X', 'family b, subgroup 1, x'),
+        ]
+        for scoped in (False, True):
+            for nodelabels in (False, True):
+                expected = TreeMaker(scoped=scoped, nodelabels=nodelabels)
+                expected.add_from(rows)
+                t = TreeMaker(
+                    scoped=scoped, nodelabels=nodelabels, backend="compact"
+                )
+                t.add_from(rows)
+                assert t.write(mode="nexus") == expected.write(mode="nexus")
+    
+    def test_treemaker_error_on_bad_backend(self):
+        with self.assertRaises(ValueError):
+            TreeMaker(backend="banana")
+
 
 class Test_TreeMakerIO(unittest.TestCase):
     """
@@ -291,6 +1031,87 @@ class Test_TreeMakerIO(unittest.TestCase):
         with self.assertRaises(ValueError):
             self.t.write(mode="banana")
     
+    def test_write_to_handle(self):
+        for mode in ('newick', 'nexus'):
+            handle = StringIO()
+            self.t.write_to_handle(handle, mode=mode)
+            assert handle.getvalue() == self.t.write(mode=mode)
+    
+    def test_write_after_edit(self):
+        t = TreeMaker()
+        t.add('A', 'a')
+        t.add('AB1', 'a, b')
+        assert t.write() == "(A,AB1);"
+        t.add('AB2', 'a, b')
+        assert t.write() == "(A,(AB1,AB2));"
+        handle = StringIO()
+        t.write_to_handle(handle)
+        assert handle.getvalue() == "(A,(AB1,AB2));"
+        t.add('C', 'c')
+        assert t.write(mode="nexus") == self.t.write(mode="nexus")
+    
+    def test_write_to_handle_small_buffer(self):
+        handle = StringIO()
+        self.t.write_to_handle(handle, mode="nexus", bufsize=1)
+        assert handle.getvalue() == self.t.write(mode="nexus")
+    
+    def test_write_to_handle_error_on_bad_method(self):
+        handle = StringIO()
+        with self.assertRaises(ValueError):
+            self.t.write_to_handle(handle, mode="banana")
+        assert handle.getvalue() == ""
+    
+    def test_write_nexus_translate(self):
+        handle = StringIO()
+        self.t.write_to_handle(handle, mode="nexus", translate=True)
+        expected = [
+            "#NEXUS", "", "begin taxa;", "   dimensions ntax=4;",
+            "   taxlabels", "      A", "      AB1", "      AB2", "      C",
+            "   ;", "end;", "", "begin trees;", "   translate",
+            "      1 A,", "      2 AB1,", "      3 AB2,", "      4 C", "   ;",
+            "   tree root = ((1,(2,3)),4);", "end;", ""
+        ]
+        assert handle.getvalue().split("\n") == expected
+    
+    def test_write_nexus_trees(self):
+        families = [(f.node, f) for f in self.t.tree.children]
+        handle = StringIO()
+        self.t.write_to_handle(handle, mode="nexus", trees=families)
+        assert handle.getvalue() == (
+            "#NEXUS\n\nbegin trees;\n"
+            "   tree a = (A,(AB1,AB2));\n   tree c = C;\nend;\n"
+        )
+        # the default is the whole tree, as in `write`
+        handle = StringIO()
+        self.t.write_to_handle(handle, mode="nexus", trees=[
+            ('root', self.t.tree)
+        ])
+        assert handle.getvalue() == self.t.write(mode="nexus")
+    
+    def test_write_nexus_translate_trees(self):
+        t = TreeMaker(backend="compact")
+        t.add("B'2", 'b')
+        t.add('A 1', 'a')
+        t.add('B1', 'b')
+        handle = StringIO()
+        t.write_to_handle(handle, mode="nexus", translate=True, trees=[
+            (f.node, f) for f in t.tree.children
+        ] + [("all taxa", t.tree)])
+        output = handle.getvalue()
+        assert "      1 'A 1',\n      2 'B''2',\n      3 B1\n   ;\n" in output
+        assert "   tree a = 1;\n   tree b = (2,3);\n" in output
+        assert "   tree 'all taxa' = (1,(2,3));\nend;\n" in output
+    
+    def test_write_translate_error_on_newick(self):
+        handle = StringIO()
+        with self.assertRaises(ValueError):
+            self.t.write_to_handle(handle, mode="newick", translate=True)
+        assert handle.getvalue() == ""
+        outfile = os.path.join(self.tmpdir, 'out_translate')
+        with self.assertRaises(ValueError):
+            self.t.write_to_file(outfile, mode="newick", trees=[])
+        assert not os.path.isfile(outfile)
+    
     def test_write_to_file_error_on_invalid_mode(self):
         outfile = os.path.join(self.tmpdir, 'out1')
         with self.assertRaises(ValueError):
@@ -360,6 +1181,635 @@ class Test_TreeMakerIO(unittest.TestCase):
         t = TreeMaker()
         t.read(outfile)
         assert str(t.tree) == '(A,B)'
+        assert t.stats.lines_parsed == 2
+
+
+class Test_ReadMemoryMap(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = mkdtemp()
+    
+    @classmethod
+    def tearDownClass(cls):
+        if cls.tmpdir and os.path.isdir(cls.tmpdir):
+            rmtree(cls.tmpdir)
+    
+    def _read(self, content, **kwargs):
+        filename = os.path.join(self.tmpdir, 'mmap.txt')
+        with open(filename, 'wb') as handle:
+            handle.write(content.encode('utf8'))
+        serial = TreeMaker()
+        serial.read(filename)
+        t = TreeMaker()
+        t.read(filename, memory_map=True)
+        assert t.write() == serial.write()
+        return list(_mmap_rows(filename, **kwargs))
+    
+    def test_read(self):
+        rows = self._read('A   a\nAB1\ta, b \nAB2  a, b\r\n\n  \nC c\n')
+        assert rows == [('A', 'a'), ('AB1', 'a, b'), ('AB2', 'a, b'), ('C', 'c')]
+    
+    def test_read_unicode(self):
+        rows = self._read(u'Kal\u00e4m\u3000TNG, Madang\nMauwake TNG\u2028X Y\n')
+        assert rows == [
+            (u'Kal\u00e4m', 'TNG, Madang'), ('Mauwake', 'TNG'), ('X', 'Y')
+        ]
+    
+    def test_read_small_blocks(self):
+        content = ''.join('Taxon%d   a, b%d\n' % (i, i % 3) for i in range(30))
+        assert self._read(content, blocksize=7) == self._read(content)
+    
+    def test_read_empty_file(self):
+        assert self._read('') == []
+    
+    def test_read_error_on_malformed(self):
+        filename = os.path.join(self.tmpdir, 'mmap-error.txt')
+        with open(filename, 'w') as handle:
+            handle.write('A   a\n\nAasasd  \n')
+        with self.assertRaises(ValueError) as error:
+            TreeMaker().read(filename, memory_map=True)
+        assert str(error.exception) == \
+            "Malformed line 3 -- I need one space: Aasasd"
+
+
+class Test_ReadParallel(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = mkdtemp()
+    
+    @classmethod
+    def tearDownClass(cls):
+        if cls.tmpdir and os.path.isdir(cls.tmpdir):
+            rmtree(cls.tmpdir)
+    
+    def _write(self, name, lines, newline="\n"):
+        filename = os.path.join(self.tmpdir, name)
+        with open(filename, 'wb') as handle:
+            handle.write(newline.join(lines).encode('utf8'))
+        return filename
+    
+    def test_split_file(self):
+        filename = self._write('split.txt', ['Taxon%d   a, b' % i for i in range(20)])
+        offsets = _split_file(filename, 8)
+        assert offsets[0] == 0 and offsets[-1] == os.path.getsize(filename)
+        assert offsets == sorted(set(offsets))
+        with open(filename, 'rb') as handle:
+            content = handle.read()
+        assert all(content[o - 1:o] == b"\n" for o in offsets[1:-1])
+    
+    def test_read_parallel(self):
+        lines = []
+        for i in range(50):
+            lines.append(u'T\u00e4xon%d   family %d, group %d' % (i, i % 3, i % 7))
+            if i % 10 == 0:
+                lines.append('')
+        for newline in ("\n", "\r\n"):
+            filename = self._write('parallel.txt', lines, newline)
+            expected = TreeMaker()
+            expected.read(filename)
+            t = TreeMaker()
+            t.read(filename, workers=2)
+            assert t.write() == expected.write()
+    
+    def test_read_parallel_error_line_number(self):
+        lines = ['Taxon%d   a, b' % i for i in range(40)]
+        lines[32] = 'Malformed'
+        filename = self._write('parallel-error.txt', lines)
+        with self.assertRaises(ValueError) as serial:
+            TreeMaker().read(filename)
+        with self.assertRaises(ValueError) as parallel:
+            TreeMaker().read(filename, workers=3)
+        assert 'line 33' in str(parallel.exception)
+        assert str(parallel.exception) == str(serial.exception)
+    
+    def test_read_parallel_error_leaves_same_tree(self):
+        lines = ['Taxon%d   f, g%d' % (i, i % 4) for i in range(40)]
+        lines[25] = 'B   f, h;i'
+        filename = self._write('parallel-bad-label.txt', lines)
+        for scoped in (False, True):
+            makers = [TreeMaker(scoped=scoped), TreeMaker(scoped=scoped)]
+            for t, workers in zip(makers, (None, 3)):
+                with self.assertRaises(ValueError) as error:
+                    t.read(filename, workers=workers)
+                assert str(error.exception) == \
+                    "Forbidden character ';' node: h;i"
+            serial, parallel = makers
+            assert parallel.write() == serial.write()
+            assert list(parallel._added) == list(serial._added)
+            for label in ('Taxon0', 'Taxon24', 'g3'):
+                assert parallel.tree.get(label) is not None
+                assert parallel.tree.get(label).node == label
+
+
+class Test_ReadStreams(unittest.TestCase):
+    content = u'A   a\nAB1\ta, b\n\nK\u00e4l\u00e4m   a, b\nC c\n'
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = mkdtemp()
+        cls.expected = TreeMaker()
+        cls.expected.read(cls.content.splitlines())
+    
+    @classmethod
+    def tearDownClass(cls):
+        if cls.tmpdir and os.path.isdir(cls.tmpdir):
+            rmtree(cls.tmpdir)
+    
+    def test_read_lines(self):
+        assert self.expected.write() == u"((A,(AB1,K\u00e4l\u00e4m)),C);"
+        assert self.expected.stats.lines_parsed == 4
+        t = TreeMaker()
+        t.read(iter(self.content.encode('utf8').splitlines(True)))
+        assert t.write() == self.expected.write()
+    
+    def test_read_file_object(self):
+        for handle in (StringIO(self.content),
+                       BytesIO(self.content.encode('utf8'))):
+            t = TreeMaker()
+            t.read(handle)
+            assert t.write() == self.expected.write()
+    
+    def test_read_compressed(self):
+        import gzip
+        import bz2
+        openers = [('.gz', gzip.open), ('.bz2', bz2.BZ2File)]
+        try:
+            import lzma
+            openers.append(('.xz', lzma.open))
+        except ImportError:  # python 2.7
+            pass
+        for extension, opener in openers:
+            filename = os.path.join(self.tmpdir, 'read.txt' + extension)
+            handle = opener(filename, 'wb')
+            handle.write(self.content.encode('utf8'))
+            handle.close()
+            for options in ({}, {'workers': 2}, {'memory_map': True}):
+                t = TreeMaker()
+                t.read(filename, **options)
+                assert t.write() == self.expected.write()
+    
+    def test_read_stdin(self):
+        options = [
+            {}, {'workers': 2}, {'memory_map': True},
+            {'cache': BuildCache(self.tmpdir)}
+        ]
+        stdin = sys.stdin
+        try:
+            for kwargs in options:
+                sys.stdin = BytesIO(self.content.encode('utf8'))
+                t = TreeMaker()
+                t.read('-', **kwargs)
+                assert t.write() == self.expected.write()
+        finally:
+            sys.stdin = stdin
+        assert t.stats.cache_hits == t.stats.cache_misses == 0
+    
+    def test_read_error_line_number(self):
+        with self.assertRaises(ValueError) as error:
+            TreeMaker().read(['A   a', '', 'Malformed'])
+        assert str(error.exception) == \
+            "Malformed line 3 -- I need one space: Malformed"
+
+
+class Test_ReadTable(unittest.TestCase):
+    rows = [
+        'taxon,family,subgroup1,subgroup2',
+        'A1,family a,subgroup 1,',
+        'A2,family a,subgroup 2',
+        'B1,"family b",subgroup 1,x',
+        '',
+        'B2, family b ,,x',
+        'C,',
+    ]
+    
+    def test_read_table(self):
+        t = TreeMaker()
+        t.read_table(self.rows)
+        assert t.write() == "(C,(A1,A2),(B1,B2));"
+        assert t.stats.lines_parsed == 5
+        assert ('B2', ('family b', 'x')) in t._added
+        assert ('C', ()) in t._added
+        # the same tree as classification strings
+        expected = TreeMaker()
+        expected.add_from([
+            ('A1', 'family a, subgroup 1'), ('A2', 'family a, subgroup 2'),
+            ('B1', 'family b, subgroup 1, x'), ('B2', 'family b, x'),
+        ])
+        expected.tree.add('C')
+        assert t.write() == expected.write()
+    
+    def test_read_table_columns(self):
+        t = TreeMaker()
+        t.read_table(self.rows, taxon='taxon', levels=['family', 3])
+        assert t.write() == "(C,(A1,A2),(B1,B2));"
+        assert ('B1', ('family b', 'x')) in t._added
+        t = TreeMaker()
+        t.read_table(
+            [row.replace(',', '\t') for row in self.rows[1:3]],
+            delimiter='\t', header=False, levels=[1]
+        )
+        assert t.write() == "(A1,A2);"
+        with self.assertRaises(ValueError):
+            TreeMaker().read_table(self.rows, levels=['family', 'missing'])
+        with self.assertRaises(ValueError):
+            TreeMaker().read_table(self.rows[1:], header=False, taxon='taxon')
+    
+    def test_read_table_stream(self):
+        content = "\n".join(self.rows).encode('utf8')
+        t = TreeMaker()
+        t.read_table(BytesIO(content))
+        expected = TreeMaker()
+        expected.read_table(self.rows)
+        assert t.write() == expected.write()
+        assert TreeMaker().read_table([]).children == []
+    
+    def test_read_table_error_on_no_taxon(self):
+        with self.assertRaises(ValueError) as error:
+            TreeMaker().read_table(self.rows[:3] + [',family a,x', ',,'])
+        assert str(error.exception) == \
+            "Malformed line 4 -- no taxon: ,family a,x"
+
+
+class Test_MRCAIndex(unittest.TestCase):
+    rows = [
+        ('A1', 'family a, subgroup 1'),
+        ('A2', 'family a, subgroup 2'),
+        ('B1a', 'family b, subgroup 1'),
+        ('B1b', 'family b, subgroup 1'),
+        ('B2', 'family b, subgroup 2'),
+        ('C', 'family c'),
+    ]
+    
+    def setUp(self):
+        self.t = TreeMaker()
+        self.t.add_from(self.rows)
+        self.index = MRCAIndex(self.t.tree)
+    
+    def test_mrca(self):
+        index, tree = self.index, self.t.tree
+        assert index.mrca('B1a', 'B1b') is tree.get('B1a').parent
+        assert index.mrca('B1b', 'B2') is tree.get('family b')
+        assert index.mrca('A1', 'C') is tree
+        assert index.mrca('A1', 'A1') is tree.get('A1')
+        assert index.mrca('A2') is tree.get('A2')
+        assert index.mrca('B1a', 'B1b', 'B2') is tree.get('family b')
+        assert index.mrca('B1a', tree.get('A1'), 'B2') is tree
+        # an ancestor of a taxon is its own MRCA with it
+        assert index.mrca('family b', 'B1a') is tree.get('family b')
+        with self.assertRaises(ValueError):
+            index.mrca('A1', 'missing')
+        with self.assertRaises(ValueError):
+            index.mrca()
+    
+    def test_mrca_batch(self):
+        pairs = [('A1', 'A2'), ('B1a', 'B2'), ('A1', 'C')]
+        assert [n.node for n in self.index.mrca_batch(pairs)] == [
+            'family a', 'family b', 'root'
+        ]
+        assert self.index.mrca_batch([]) == []
+    
+    def test_depth_and_path_to_root(self):
+        assert self.index.depth('B1a') == 3
+        assert self.index.depth('C') == 2
+        assert self.index.depth(self.t.tree) == 0
+        assert [n.node for n in self.index.path_to_root('B1a')] == [
+            'B1a', 'subgroup 1', 'family b', 'root'
+        ]
+        assert len(self.index) == len(list(self.t.tree.preorder()))
+    
+    def test_subtree(self):
+        index = MRCAIndex(self.t.tree.get('family b'))
+        assert index.mrca('B1a', 'B2').node == 'family b'
+        assert index.depth('B2') == 2
+        with self.assertRaises(ValueError):
+            index.mrca('A1', 'B2')  # not below "family b"
+    
+    def test_first_match_like_get(self):
+        t = TreeMaker()
+        t.add_from(self.rows + [('x', 'family a, subgroup 1'), ('x', 'family c')])
+        index = MRCAIndex(t.tree)
+        assert index.mrca('x', 'A1') is t.tree.get('A1').parent
+    
+    def test_compact(self):
+        t = TreeMaker(backend="compact")
+        t.add_from(self.rows)
+        index = MRCAIndex(t.tree)
+        assert index.mrca('B1b', 'B2').node == 'family b'
+        assert index.mrca('B1a', 'B1b').id == t.tree.get('B1a').parent.id
+        assert [n.node for n in index.path_to_root('C')] == [
+            'C', 'family c', 'root'
+        ]
+
+
+@unittest.skipIf(numpy is None, "needs NumPy")
+class Test_DistanceMatrix(unittest.TestCase):
+    rows = Test_MRCAIndex.rows
+    
+    def setUp(self):
+        self.t = TreeMaker()
+        self.t.add_from(self.rows)
+    
+    def test_shared(self):
+        m = self.t.tree.distance_matrix()
+        assert [n.node for n in self.t.tree.tips()] == [
+            'A1', 'A2', 'B1a', 'B1b', 'B2', 'C'
+        ]
+        assert m.dtype == numpy.float64
+        assert m.tolist() == [
+            [3, 1, 0, 0, 0, 0],
+            [1, 3, 0, 0, 0, 0],
+            [0, 0, 3, 2, 1, 0],
+            [0, 0, 2, 3, 1, 0],
+            [0, 0, 1, 1, 3, 0],
+            [0, 0, 0, 0, 0, 2],
+        ]
+    
+    def test_patristic(self):
+        m = self.t.tree.distance_matrix(kind="patristic", dtype="int32")
+        assert m.dtype == numpy.int32
+        assert m[0].tolist() == [0, 4, 6, 6, 6, 5]
+        assert (m == m.T).all() and not m.diagonal().any()
+        with self.assertRaises(ValueError):
+            self.t.tree.distance_matrix(kind="other")
+    
+    def test_subtree_and_empty(self):
+        m = self.t.tree.get('family b').distance_matrix()
+        assert m.tolist() == [[2, 1, 0], [1, 2, 0], [0, 0, 2]]
+        assert Tree('root').distance_matrix().shape == (0, 0)
+    
+    def test_memmap_and_workers(self):
+        t = TreeMaker()
+        t.add_from([
+            ('t%d' % i, 'f%d, g%d' % (i % 7, i % 3)) for i in range(600)
+        ])
+        expected = t.tree.distance_matrix(dtype="float32")
+        tmpdir = mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'distances.npy')
+            m = t.tree.distance_matrix(
+                dtype="float32", filename=filename, workers=3
+            )
+            assert (m == expected).all()
+            del m
+            assert (numpy.load(filename) == expected).all()
+        finally:
+            rmtree(tmpdir)
+    
+    def test_write_distances(self):
+        from treemaker.distances import write_distances
+        handle = StringIO()
+        write_distances(self.t.tree.get('family b'), handle)
+        assert handle.getvalue() == (
+            "taxon\tB1a\tB1b\tB2\n"
+            "B1a\t2\t1\t0\n"
+            "B1b\t1\t2\t0\n"
+            "B2\t0\t0\t2\n"
+        )
+
+
+class Test_Snapshot(unittest.TestCase):
+    rows = [
+        ('A1', 'family a, subgroup 1'),
+        ('A2', 'family a, subgroup 2'),
+        (u'B1\u00e4', 'family b, subgroup 1'),
+        ('B1b', 'family b, subgroup 1'),
+        ('B2', 'family b, subgroup 2'),
+        ('X', 'family b, subgroup 1, x'),
+        ('Y', 'x'),
+    ]
+    
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'tree.snapshot')
+    
+    def tearDown(self):
+        rmtree(self.tmpdir)
+    
+    def test_roundtrip(self):
+        for backend in ('tree', 'compact'):
+            for scoped in (False, True):
+                t = TreeMaker(nodelabels=True, scoped=scoped, backend=backend)
+                t.add_from(self.rows)
+                t.save_snapshot(self.filename)
+                for load_backend in ('tree', 'compact'):
+                    loaded = TreeMaker.load_snapshot(
+                        self.filename, backend=load_backend
+                    )
+                    assert loaded.scoped == scoped
+                    assert loaded.tree.show_nodelabels
+                    assert loaded.write(mode="nexus") == t.write(mode="nexus")
+    
+    def test_lookups_and_adding_after_load(self):
+        t = TreeMaker()
+        t.add_from(self.rows)
+        t.save_snapshot(self.filename)
+        loaded = TreeMaker.load_snapshot(self.filename)
+        # the first "x" added is still the one found
+        assert loaded.tree.get('x').parent.node == 'subgroup 1'
+        with self.assertRaises(ValueError):
+            loaded.add('A1', 'family a, subgroup 1')  # duplicate
+        t.add('Z', 'x')
+        loaded.add('Z', 'x')
+        assert loaded.write() == t.write()
+        # the node added for each taxon is saved, so it can be removed
+        t.save_snapshot(self.filename)
+        loaded = TreeMaker.load_snapshot(self.filename)
+        for maker in (t, loaded):
+            maker.remove('A1', 'family a, subgroup 1', prune=False)
+        assert loaded.write() == t.write()
+    
+    def test_path_classifications(self):
+        t = TreeMaker()
+        t.add('A', ('family, a', 'subgroup 1'))
+        t.add('B', ())
+        t.add('C', 'family, a')
+        t.save_snapshot(self.filename)
+        loaded = TreeMaker.load_snapshot(self.filename)
+        assert loaded._added.keys() == t._added.keys()
+        loaded.remove('A', ('family, a', 'subgroup 1'))
+        assert loaded.write() == "(B,C);"
+        t.add('D', ('bad\x1flabel',))
+        with self.assertRaises(ValueError):
+            t.save_snapshot(os.path.join(self.tmpdir, 'bad.snapshot'))
+    
+    def test_empty_tree(self):
+        t = TreeMaker(label="")
+        t.save_snapshot(self.filename)
+        assert TreeMaker.load_snapshot(self.filename).write() == ";"
+    
+    def test_error_on_bad_file(self):
+        t = TreeMaker()
+        t.add_from(self.rows)
+        t.save_snapshot(self.filename)
+        with open(self.filename, 'rb') as handle:
+            data = bytearray(handle.read())
+        for name, content in [
+            ('text', b'A   a\n'),
+            ('truncated', data[:-3]),
+            ('corrupt', data[:-5] + bytearray([data[-5] ^ 1]) + data[-4:]),
+            ('version', data[:8] + bytearray([99, 0]) + data[10:]),
+        ]:
+            filename = os.path.join(self.tmpdir, name)
+            with open(filename, 'wb') as handle:
+                handle.write(bytes(content))
+            with self.assertRaises(ValueError):
+                TreeMaker.load_snapshot(filename)
+
+
+class Test_BuildCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.cache = BuildCache(os.path.join(self.tmpdir, 'cache'))
+        self.filename = self._write('input.txt', 'A1   a, b\nA2   a, c\nC   c\n')
+    
+    def tearDown(self):
+        rmtree(self.tmpdir)
+    
+    def _write(self, name, content):
+        filename = os.path.join(self.tmpdir, name)
+        with open(filename, 'w') as handle:
+            handle.write(content)
+        return filename
+    
+    def _entries(self):
+        return sorted(os.listdir(self.cache.directory))
+    
+    def test_miss_then_hit(self):
+        first = TreeMaker(nodelabels=True)
+        first.read(self.filename, cache=self.cache)
+        assert first.stats.cache_misses == 1 and first.stats.cache_hits == 0
+        assert len(self._entries()) == 1
+        for backend in ('tree', 'compact'):
+            t = TreeMaker(nodelabels=True, backend=backend)
+            t.read(self.filename, cache=self.cache)
+            assert t.stats.cache_hits == 1 and t.stats.lines_parsed == 0
+            assert t.write() == first.write()
+            with self.assertRaises(ValueError):
+                t.add('C', 'c')  # the added taxa were restored too
+        assert (self.cache.hits, self.cache.misses) == (2, 1)
+    
+    def test_key(self):
+        key = self.cache.key(self.filename, TreeMaker())
+        assert key == self.cache.key(self.filename, TreeMaker())
+        assert key != self.cache.key(self.filename, TreeMaker(nodelabels=True))
+        assert key != self.cache.key(self.filename, TreeMaker(label="x"))
+        assert key != self.cache.key(self.filename, TreeMaker(scoped=True))
+        self._write('input.txt', 'A1   a, b\n')
+        assert key != self.cache.key(self.filename, TreeMaker())
+    
+    def test_not_used_after_adding(self):
+        t = TreeMaker()
+        t.add('X', 'x')
+        t.read(self.filename, cache=self.cache)
+        assert self._entries() == []
+        assert t.stats.cache_misses == 0
+    
+    def test_corrupt_entry(self):
+        TreeMaker().read(self.filename, cache=self.cache)
+        entry = os.path.join(self.cache.directory, self._entries()[0])
+        with open(entry, 'wb') as handle:
+            handle.write(b'junk')
+        t = TreeMaker()
+        t.read(self.filename, cache=self.cache)
+        assert t.stats.cache_misses == 1
+        expected = TreeMaker()
+        expected.read(self.filename)
+        assert t.write() == expected.write()
+        # ... and the entry was replaced
+        assert TreeMaker.load_snapshot(entry).write() == expected.write()
+    
+    def test_evict_least_recently_used(self):
+        names = ['a.txt', 'b.txt', 'c.txt']
+        keys = []
+        for i, name in enumerate(names):
+            filename = self._write(name, 'T%d   x%d\n' % (i, i))
+            TreeMaker().read(filename, cache=self.cache)
+            keys.append(self.cache.key(filename, TreeMaker()))
+        for i, key in enumerate(keys):  # a is oldest, c newest
+            path = os.path.join(self.cache.directory, key + '.snapshot')
+            os.utime(path, (1000 + i, 1000 + i))
+        self.cache.get(keys[0])  # ... until a is used again
+        size = os.path.getsize(path)
+        self.cache.max_size = 2 * size
+        assert self.cache.evict() == 1
+        assert self._entries() == sorted(
+            [keys[0] + '.snapshot', keys[2] + '.snapshot']
+        )
+
+
+class Test_Batch(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.files = {
+            'a.txt': 'A1   a, b\nA2   a, c\n',
+            'b.txt': 'B1   b\nB2   b\nC    c\n',
+            'bad.txt': 'Malformed\n',
+        }
+        for name, content in self.files.items():
+            with open(os.path.join(self.tmpdir, name), 'w') as handle:
+                handle.write(content)
+    
+    def tearDown(self):
+        rmtree(self.tmpdir)
+    
+    def _path(self, *names):
+        return os.path.join(self.tmpdir, *names)
+    
+    def _read(self, *names):
+        with open(self._path(*names)) as handle:
+            return handle.read()
+    
+    def test_outdir(self):
+        args = parse_options([
+            self._path('a.txt'), self._path('bad.txt'), self._path('b.txt'),
+            '--outdir', self._path('out'), '-j', '1'
+        ])
+        report = _run_batch(args)
+        assert [r[2] is None for r in report] == [True, False, True]
+        assert 'Malformed line 1' in report[1][2]
+        assert self._read('out', 'a.nwk') == '(A1,A2);'
+        assert self._read('out', 'b.nwk') == '((B1,B2),C);'
+        assert not os.path.exists(self._path('out', 'bad.nwk'))
+    
+    def test_manifest(self):
+        with open(self._path('manifest.tsv'), 'w') as handle:
+            handle.write('# input\toutput\n')
+            handle.write('a.txt\ta.nex\n\n')
+            handle.write('missing.txt\n')
+            handle.write('b.txt\n')
+        args = parse_options([
+            '--batch', self._path('manifest.tsv'), '--outdir',
+            self._path('out'), '-m', 'nexus', '-l', '-j', '2'
+        ])
+        report = _run_batch(args)
+        assert [r[2] is None for r in report] == [True, False, True]
+        assert report[0][1] == self._path('a.nex')
+        assert 'tree root = (A1,A2)a;' in self._read('a.nex')
+        assert 'tree root = ((B1,B2)b,C)root;' in self._read('out', 'b.nex')
+    
+    def test_duplicate_outputs(self):
+        os.mkdir(self._path('sub'))
+        with open(self._path('sub', 'a.txt'), 'w') as handle:
+            handle.write('X   x\n')
+        args = parse_options([
+            self._path('a.txt'), self._path('sub', 'a.txt'),
+            '--outdir', self._path('out'), '-j', '1'
+        ])
+        report = _run_batch(args)
+        assert report[0][2] is None
+        assert 'used by another input' in report[1][2]
+        assert self._read('out', 'a.nwk') == '(A1,A2);'
+    
+    def test_bad_options(self):
+        a = self._path('a.txt')
+        with self.assertRaises(SystemExit):
+            parse_options([])
+        with self.assertRaises(SystemExit):
+            parse_options([a, a])  # needs --outdir
+        with self.assertRaises(SystemExit):
+            parse_options([a, '--outdir', self.tmpdir, '-o', 'x'])
+        with self.assertRaises(IOError):
+            parse_options(['--batch', self._path('missing.tsv')])
 
 
 class Test_ParseArgs(unittest.TestCase):
@@ -399,6 +1849,83 @@ class Test_ParseArgs(unittest.TestCase):
         assert m == 'nexus'
         assert n == False  # default
 
+    def test_parse_jobs(self):
+        assert parse_options(['%s' % __file__]).jobs is None
+        assert parse_options(['%s' % __file__, '-j', '4']).jobs == 4
+        assert parse_options(['%s' % __file__, '--jobs', '2']).jobs == 2
+
+    def test_parse_stats_and_profile(self):
+        args = parse_options(['%s' % __file__])
+        assert args.stats is False and args.profile is None
+        args = parse_options(['%s' % __file__, '--stats', '--profile', 'x.prof'])
+        assert args.stats is True and args.profile == 'x.prof'
+        with self.assertRaises(SystemExit):
+            parse_options(['--outdir', 'out', '--stats', __file__])
+        with self.assertRaises(SystemExit):
+            parse_options(['--outdir', 'out', '--profile', 'x.prof', __file__])
+
+    def test_parse_snapshots(self):
+        args = parse_options(['%s' % __file__, '--save-snapshot', 'x.snap'])
+        assert args.save_snapshot == 'x.snap' and not args.load_snapshot
+        assert parse_options(['%s' % __file__, '--load-snapshot']).load_snapshot
+        with self.assertRaises(SystemExit):
+            parse_options([
+                '--outdir', 'out', '--save-snapshot', 'x.snap', __file__
+            ])
+        with self.assertRaises(SystemExit):
+            parse_options(['--outdir', 'out', '--load-snapshot', __file__])
+
+    def test_parse_taxa(self):
+        args = parse_options(['%s' % __file__, '--taxa', '%s' % __file__])
+        assert args.taxa == __file__
+        with self.assertRaises(IOError):
+            parse_options(['%s' % __file__, '--taxa', 'missing.txt'])
+        with self.assertRaises(SystemExit):
+            parse_options(['--outdir', 'out', '--taxa', __file__, __file__])
+
+    def test_parse_distances(self):
+        args = parse_options(['%s' % __file__, '--distances', 'd.tsv'])
+        assert args.distances == 'd.tsv' and args.distance_kind == 'shared'
+        args = parse_options([
+            '%s' % __file__, '--distances', 'd.tsv',
+            '--distance-kind', 'patristic'
+        ])
+        assert args.distance_kind == 'patristic'
+        with self.assertRaises(SystemExit):
+            parse_options(['--outdir', 'out', '--distances', 'd.tsv', __file__])
+
+    def test_parse_stdin(self):
+        args = parse_options(['-'])
+        assert args.input == '-'
+        with self.assertRaises(SystemExit):
+            parse_options(['-', '--load-snapshot'])
+
+    def test_parse_format(self):
+        assert parse_options(['%s' % __file__]).format == 'text'
+        assert parse_options(['%s' % __file__, '-f', 'csv']).format == 'csv'
+        with self.assertRaises(SystemExit):
+            parse_options(['%s' % __file__, '--format', 'xls'])
+        with self.assertRaises(SystemExit):
+            parse_options(['--outdir', 'out', '--format', 'tsv', __file__])
+
+    def test_parse_translate(self):
+        args = parse_options([
+            '%s' % __file__, '-m', 'nexus', '--translate', '--per-family'
+        ])
+        assert args.translate and args.per_family
+        with self.assertRaises(SystemExit):
+            parse_options(['%s' % __file__, '--translate'])
+        with self.assertRaises(SystemExit):
+            parse_options([
+                '--outdir', 'out', '-m', 'nexus', '--per-family', __file__
+            ])
+
+    def test_parse_cache(self):
+        args = parse_options(['%s' % __file__, '--cache', 'dir'])
+        assert args.cache == 'dir' and args.cache_size == 1024
+        args = parse_options(['%s' % __file__, '--cache', 'dir', '--no-cache'])
+        assert args.cache is None
+
     def test_parse_nodelabels(self):
         i, m, o, n = parse_args(['%s' % __file__, '-l'])
         assert i == __file__
@@ -8,10 +8,35 @@ __license__ = 'New-style BSD'
 import os
 import re
 import sys
+import mmap
 import codecs
+import csv
+import gc
 import argparse
+from itertools import count
+from collections import deque, OrderedDict
+from bisect import bisect_left, insort_right
+from operator import attrgetter
 from functools import total_ordering
 
+from .stats import Stats
+
+try:
+    from sys import intern
+except ImportError:  # python 2.7, where only byte strings can be interned
+    def intern(string, _intern=intern):
+        return _intern(string) if isinstance(string, str) else string
+
+if sys.version_info < (3, 7):  # plain dicts keep their order from 3.7
+    _ordered_dict = OrderedDict
+else:
+    _ordered_dict = dict
+
+try:
+    STRING_TYPES = (basestring,)  # python 2.7
+except NameError:
+    STRING_TYPES = (str,)
+
 VERSION = "1.4"
 
 NEXUS_TEMPLATE = """#NEXUS
@@ -23,26 +48,165 @@ end;
 
 BADCHARS = "();"
 
-IS_WHITESPACE = re.compile(r"""\s+""")
+# input files with these extensions are decompressed as they are read
+COMPRESSED = ('.gz', '.bz2', '.xz')
+
+# --format -> delimiter of the table
+DELIMITERS = {'csv': ",", 'tsv': "\t"}
+
+IS_WHITESPACE = re.compile(r"""\s+""", re.UNICODE)
+
+# characters that NEXUS treats as punctuation, so labels with them are quoted
+NEXUS_PUNCTUATION = re.compile(r"""[\s()\[\]{}/\\,;:=*'"`+<>-]""", re.UNICODE)
+
+# Bytes that the memory-mapped reader cannot handle without decoding:
+# non-ASCII text, and line breaks or spaces that bytes.split() does not know.
+NEEDS_DECODING = re.compile(b"[\x80-\xff\x0b\x0c\x1c-\x1f]|\r(?!\n)")
+
+BUFSIZE = 65536  # characters collected before each write when streaming
+
+_by_seq = attrgetter('_seq')
+
+
+class Traversals(object):
+    """
+    Iterative tree traversals shared by `Tree` and
+    `treemaker.compact.CompactNode`. They use an explicit stack or queue
+    rather than recursion, so they work on trees of any depth.
+
+    Each traversal yields nodes or, with `detailed=True`, tuples of
+    (node, depth, parent), where depth is counted from the starting node.
+    """
+    __slots__ = ()
+    
+    def preorder(self, detailed=False):
+        """
+        Iterates over this node and its descendants, parents before
+        children.
+
+        Args:
+            detailed (boolean): yield (node, depth, parent) tuples (default=False)
+
+        Returns:
+            Iterator[treemaker.Tree]: the nodes.
+        """
+        stack = [(self, 0, self.parent)]
+        while stack:
+            node, depth, parent = stack.pop()
+            yield (node, depth, parent) if detailed else node
+            children = node.children
+            if children:
+                stack.extend(
+                    (child, depth + 1, node) for child in reversed(children)
+                )
+    
+    def postorder(self, detailed=False):
+        """
+        Iterates over this node and its descendants, children before
+        parents.
+
+        Args:
+            detailed (boolean): yield (node, depth, parent) tuples (default=False)
+
+        Returns:
+            Iterator[treemaker.Tree]: the nodes.
+        """
+        stack = [(self, 0, self.parent, False)]
+        while stack:
+            node, depth, parent, expanded = stack.pop()
+            children = None if expanded else node.children
+            if children:
+                stack.append((node, depth, parent, True))
+                stack.extend(
+                    (child, depth + 1, node, False)
+                    for child in reversed(children)
+                )
+            else:
+                yield (node, depth, parent) if detailed else node
+    
+    def levelorder(self, detailed=False):
+        """
+        Iterates over this node and its descendants one level at a time.
+
+        Args:
+            detailed (boolean): yield (node, depth, parent) tuples (default=False)
+
+        Returns:
+            Iterator[treemaker.Tree]: the nodes.
+        """
+        queue = deque([(self, 0, self.parent)])
+        while queue:
+            node, depth, parent = queue.popleft()
+            yield (node, depth, parent) if detailed else node
+            queue.extend((child, depth + 1, node) for child in node.children)
+    
+    def tips(self, node=None, detailed=False):
+        """
+        Returns the tips in the tree, in the same order as the Newick output.
+
+        Args:
+            node (treemaker.Tree): (optional) parent node. Default is current 
+                node.
+            detailed (boolean): yield (node, depth, parent) tuples (default=False)
+
+        Returns:
+            List[treemaker.Tree]: the tip nodes from the given node.
+        """
+        node = self if node is None else node
+        stack = [(child, 1, node) for child in reversed(node.children)]
+        while stack:
+            node, depth, parent = stack.pop()
+            children = node.children
+            if children:
+                stack.extend(
+                    (child, depth + 1, node) for child in reversed(children)
+                )
+            else:
+                yield (node, depth, parent) if detailed else node
 
 
 @total_ordering
-class Tree(object):
+class Tree(Traversals):
     """
     Tree object to represent the classification taxonomy.
 
+    The nodelabel setting is held once by the root of the tree and applies
+    to every node in it, including subtrees added from elsewhere.
+
     Args:
         node (str): Label for this node.
         children (list): Optional list of children nodes
         show_nodelabels (boolean): A flag to show nodelabels or not (default=False)
     """
+    __slots__ = (
+        'node', 'children', 'parent', '_index', '_child_index', '_inner',
+        '_seq', '_first', '_show_nodelabels', '_newick',
+    )
+    
+    _counter = count()
+
     def __init__(self, node=None, children=None, show_nodelabels=False):
         self.children = []
-        self.show_nodelabels = show_nodelabels
+        self.parent = None
+        # only used on the root, see `show_nodelabels`
+        self._show_nodelabels = show_nodelabels
+        # label -> first matching descendant (in depth-first order) and
+        # label -> first direct child, created when the first child is added.
+        self._index = None
+        self._child_index = None
+        # the children that have children of their own, in insertion order
+        self._inner = None
+        # insertion order, used to rank siblings in the depth-first order
+        self._seq = next(self._counter)
+        # `_seq` of the first child ever added to this node
+        self._first = None
+        # cached Newick fragment for this subtree, None when out of date.
+        # If an internal node has no fragment, neither do its ancestors.
+        self._newick = None
         if node is None:
             self.node = ''
         else:
-            self.node = self._sanitise(str(node))
+            self.node = intern(self._sanitise(_as_label(node)))
         
         if children is not None:
             [self.add(child) for child in children]
@@ -53,6 +217,26 @@ class Tree(object):
     def __eq__(self, other):
         return self.node == other.node
     
+    @property
+    def root(self):
+        """Returns the root of the tree this node belongs to"""
+        node = self
+        while node.parent is not None:
+            node = node.parent
+        return node
+    
+    @property
+    def show_nodelabels(self):
+        """Returns True if nodelabels are shown for this tree"""
+        return self.root._show_nodelabels
+    
+    @show_nodelabels.setter
+    def show_nodelabels(self, value):
+        root = self.root
+        if root._show_nodelabels != value:
+            root._clear_newick()
+        root._show_nodelabels = value
+    
     @property
     def is_tip(self):
         """Returns True if node is a tip"""
@@ -75,29 +259,389 @@ class Tree(object):
             treemaker.Tree: the created node matching `label`.
         """
         if not isinstance(node, Tree):
-            node = Tree(node, children, show_nodelabels=self.show_nodelabels)
+            node = Tree(node, children)
+        elif node.show_nodelabels != self.show_nodelabels:
+            node._clear_newick()  # its fragments use the other setting
         self._sanitise(node.node)
-        self.children.append(node)
+        self._attach(node)
+        self._update_index(node)
+        return node
+    
+    def remove(self, node, prune=False):
+        """
+        Removes a node (and its subtree) from the tree below this node. Like
+        `add`, this only updates the nodes between the removed node and the
+        root.
+
+        Args:
+            node (str or treemaker.Tree): the node, or a label to find it
+                with `get`.
+            prune (boolean): also remove the ancestors left with no children,
+                up to this node (default=False)
+
+        Returns:
+            treemaker.Tree: the root of the removed subtree.
+
+        Raises:
+            ValueError: if the node is not below this node.
+        """
+        if not isinstance(node, Tree):
+            label, node = node, self.get(node)
+            if node is None:
+                raise ValueError("Node not found: %s" % label)
+        elif node is self or not self._contains(node):
+            raise ValueError("%r is not below %r" % (node, self))
+        if prune:
+            while node.parent is not self and len(node.parent.children) == 1:
+                node = node.parent
+        node.parent._detach(node)
         return node
     
-    def get_or_create(self, label):
+    def move(self, node, new_parent):
+        """
+        Moves a node (and its subtree) below this node to `new_parent`. Like
+        `add`, this only updates the nodes between the old and new parents
+        and the root.
+
+        Changes made directly to the tree of a `TreeMaker` are not tracked by
+        it, so use `TreeMaker.remove` to remove taxa from those.
+
+        Args:
+            node (treemaker.Tree): the node to move.
+            new_parent (treemaker.Tree): its new parent, this node or a node
+                below it.
+
+        Returns:
+            treemaker.Tree: the moved node.
+
+        Raises:
+            ValueError: if either node is not in this tree, or `new_parent` is
+                `node` or below it.
+        """
+        if node is self or not self._contains(node):
+            raise ValueError("%r is not below %r" % (node, self))
+        if not self._contains(new_parent):
+            raise ValueError("%r is not in %r" % (new_parent, self))
+        if node._contains(new_parent):
+            raise ValueError("Cannot move %r below itself" % node)
+        node.parent._detach(node)
+        new_parent._attach(node)
+        new_parent._update_index(node)
+        return node
+    
+    def _contains(self, node):
+        """Returns True if `node` is this node or below it"""
+        while node is not None:
+            if node is self:
+                return True
+            node = node.parent
+        return False
+    
+    def subset(self, taxa):
+        """
+        Returns the subtree of this tree induced by `taxa`: a new tree with
+        only the nodes that lead from this node to `taxa`, in the same
+        places and order as they are here. Clades left with a single child
+        are kept, and collapsed in the Newick output as usual. The cost
+        depends on the number of taxa and their depth rather than the size
+        of this tree, which is left unchanged.
+
+        For a tree built by a scoped `TreeMaker`, or one where no label is
+        used twice, this is the same tree as building from just the rows
+        of these taxa. Otherwise it may not be: an unscoped build attaches
+        a classification to the first node with its label, which can
+        depend on rows that are left out here.
+
+        >>> str(tree.subset(['A1', 'B1a', 'B1b']))
+        '(A1,(B1a,B1b))'
+
+        Args:
+            taxa (iter): taxon labels (found with `get`) or nodes below this
+                node.
+
+        Returns:
+            treemaker.Tree: the new tree, with a root labelled like this node.
+
+        Raises:
+            ValueError: if a taxon is not found below this node.
+        """
+        kept = {}  # id of each node kept -> its children that are kept
+        for taxon in taxa:
+            if isinstance(taxon, Tree):
+                node = taxon
+                if not self._contains(node):
+                    raise ValueError("%r is not below %r" % (node, self))
+            else:
+                node = self.get(taxon)
+                if node is None:
+                    raise ValueError("Taxon not found: %s" % taxon)
+            if id(node) in kept:
+                continue
+            kept[id(node)] = []
+            while node is not self:
+                children = kept.get(id(node.parent))
+                if children is not None:
+                    children.append(node)
+                    break
+                kept[id(node.parent)] = [node]
+                node = node.parent
+        
+        root = Tree(self.node, show_nodelabels=self.show_nodelabels)
+        stack = [(self, root)]
+        while stack:
+            node, copy = stack.pop()
+            for child in sorted(kept.get(id(node), ()), key=_by_seq):
+                stack.append((child, copy._attach(Tree(child.node))))
+        root._reindex()
+        return root
+    
+    def distance_matrix(self, kind="shared", dtype="float64", filename=None,
+                        workers=1):
+        """
+        Returns the matrix of distances between every pair of tips below
+        this node, in the order of `tips`, computed with NumPy. See
+        `treemaker.distances.distance_matrix`.
+
+        Args:
+            kind (str): "shared" for the depth of the most recent common
+                ancestor, or "patristic" for the number of branches between
+                the tips (default="shared")
+            dtype (str or numpy.dtype): the type of the matrix, e.g. "float32"
+                (default="float64")
+            filename (str): write the matrix to this ".npy" file through a
+                memory map (default=None)
+            workers (int): the number of threads to fill it with (default=1)
+
+        Returns:
+            numpy.ndarray: the matrix.
+
+        Raises:
+            ImportError: if NumPy is not installed.
+            ValueError: if kind is not "shared" or "patristic".
+        """
+        from .distances import distance_matrix
+        return distance_matrix(
+            self, kind=kind, dtype=dtype, filename=filename, workers=workers
+        )
+    
+    def _attach(self, node):
+        """
+        Adds `node` to the children of this node without updating the label
+        index of the ancestors. Call `_reindex` afterwards.
+
+        Children are kept in label order, with nodes that share a label kept
+        in the order they were added.
+        """
+        node.parent = self
+        node._seq = next(self._counter)
+        children = self.children
+        if not children:
+            if self.parent is not None:
+                self.parent._add_inner(self)
+            if self._first is None:
+                self._first = node._seq
+            children.append(node)
+        elif not node < children[-1]:
+            children.append(node)
+        else:
+            insort_right(children, node)
+        if node.children:
+            self._add_inner(node)
+        if self._child_index is None:
+            self._index, self._child_index = {}, {}
+        self._child_index.setdefault(node.node, node)
+        self._invalidate()
+        return node
+    
+    def _add_inner(self, child):
+        """Adds `child`, which now has children, to `_inner`"""
+        inner = self._inner
+        if inner is None:
+            self._inner = [child]
+        elif inner[-1]._seq < child._seq:
+            inner.append(child)
+        else:
+            inner.insert(_seq_position(inner, child._seq), child)
+    
+    def _remove_inner(self, child):
+        """Removes `child` from `_inner` when it leaves or loses its children"""
+        inner = self._inner
+        del inner[_seq_position(inner, child._seq)]
+        if not inner:
+            self._inner = None
+    
+    def _detach(self, node):
+        """
+        Removes the child `node` (and its subtree) from this node, and drops
+        the labels in its subtree from the label index of this node and its
+        ancestors, falling back to the next match in depth-first order.
+        """
+        children = self.children
+        i = bisect_left(children, node)
+        while children[i] is not node:
+            i += 1
+        del children[i]
+        node.parent = None
+        if node.children:
+            self._remove_inner(node)
+        if not children and self.parent is not None:
+            self.parent._remove_inner(self)
+        if self._child_index.get(node.node) is node:
+            # children sharing a label are kept in the order they were added
+            i = bisect_left(children, node)
+            if i < len(children) and children[i].node == node.node:
+                self._child_index[node.node] = children[i]
+            else:
+                del self._child_index[node.node]
+        self._invalidate()
+        
+        # the nodes in the removed subtree that an index may point to
+        gone = set(map(id, node._index.values())) if node._index else set()
+        gone.add(id(node))
+        labels = set(node._index or ())
+        labels.add(node.node)
+        ancestor, below = self, node
+        while ancestor is not None:
+            index = ancestor._index
+            stale = [
+                label for label in labels
+                if id(index.get(label)) in gone
+            ]
+            if not stale:
+                break
+            # the old match came first in `ancestor`, so a new one is either
+            # the new match below it or in a later sibling of `below`. Any
+            # other node with the label there comes after the old match, so
+            # it is the first child with the label or the first match in
+            # the earliest added child with the label below it. Only the
+            # children with children of their own can have it below them.
+            found = {}
+            if below is not node and below._index:
+                for label in stale:
+                    match = below._index.get(label)
+                    if match is not None:
+                        found[label] = match
+            for label in stale:
+                if label in found:
+                    continue
+                match = ancestor.get_child(label)
+                for child in ancestor._inner or ():
+                    if match is not None and child._seq >= match._seq:
+                        break
+                    if label in child._index:
+                        match = child._index[label]
+                        break
+                if match is not None:
+                    found[label] = match
+            for label in stale:
+                if label in found:
+                    index[label] = found[label]
+                else:
+                    del index[label]
+            labels = stale
+            ancestor, below = ancestor.parent, ancestor
+    
+    def _invalidate(self):
+        """
+        Marks the cached Newick fragment of this node and its ancestors as
+        out of date.
+        """
+        self._newick = None
+        node = self.parent
+        while node is not None and node._newick is not None:
+            node._newick = None
+            node = node.parent
+    
+    def _clear_newick(self):
+        """Drops every cached Newick fragment in this subtree"""
+        for node in self.preorder():
+            node._newick = None
+    
+    def _reindex(self):
+        """
+        Rebuilds the label index of every node in this subtree in one pass.
+        """
+        for node in self.postorder():
+            if not node.children:
+                continue
+            # last child first, so that earlier matches overwrite later ones
+            index = {}
+            for child in sorted(node.children, key=_by_seq, reverse=True):
+                if child._index:
+                    index.update(child._index)
+                index[child.node] = child
+            node._index = index
+    
+    def _update_index(self, node):
+        """
+        Registers the labels in the subtree of `node` (a newly added child of
+        this node) with the label index of this node and its ancestors.
+        """
+        found = dict(node._index or ())
+        found[node.node] = node  # `node` precedes its descendants.
+        ancestor = self
+        while found and ancestor is not None:
+            index = ancestor._index
+            for label in list(found):
+                current = index.get(label)
+                if current is not None and self._precedes(current, ancestor):
+                    # the existing match comes first here, so it also comes
+                    # first in every ancestor further up.
+                    del found[label]
+                else:
+                    index[label] = found[label]
+            ancestor = ancestor.parent
+    
+    def _precedes(self, other, ancestor):
+        """
+        Returns True if `other` (a node below `ancestor`) comes before the
+        most recently added child of this node in depth-first order.
+        """
+        path = {}
+        node, child = self, None
+        while node is not ancestor:
+            path[id(node)] = child
+            node, child = node.parent, node
+        path[id(ancestor)] = child
+        # walk up from `other` until we join the path from `ancestor` to us.
+        branch = None
+        while id(other) not in path:
+            other, branch = other.parent, other
+        if branch is None or other is self:
+            # `other` is on the path, or under us and so before our new child.
+            return True
+        return branch._seq < path[id(other)]._seq
+    
+    def get_or_create(self, label, scoped=False):
         """
         Helper function to get or create a node.
 
         Args:
             label (str): Label for this node.
+            scoped (boolean): Only look for `label` among the direct children
+                of this node rather than the whole subtree (default=False)
 
         Returns:
             treemaker.Tree: the found or created node matching `label`.
         """
-        found = self.get(label)
+        found = self.get_child(label) if scoped else self.get(label)
         if found:
             return found
         return self.add(label)
     
     def get(self, label, node=None):
         """
-        Searches tree for node `label`.
+        Searches tree for node `label`. If several nodes match, the first one
+        found in a depth-first search that visits children in the order they
+        were added is returned. Lookups use an index kept up to date by `add`,
+        so nodes should not be appended to `children` directly.
+
+        Every internal node indexes each distinct label below it, so the
+        index holds about one entry per node per level above it: memory and
+        the cost of `add` grow with the depth of the tree, and with the
+        square of the depth for a single deep chain of clades (e.g. a
+        classification 4,000 levels deep takes tens of seconds and hundreds
+        of MB to add). The "compact" backend of `TreeMaker` avoids this.
 
         Args:
             label (str): Label for this node.
@@ -108,34 +652,22 @@ class Tree(object):
             treemaker.Tree: the found or created node matching `label`.
         """
         node = self if node is None else node
-        for child in node.children:
-            if child.node == label:
-                return child
-            found = self.get(label, child)
-            if found:
-                return found
-        return None
+        return node._index.get(label) if node._index else None
     
-    def tips(self, node=None):
+    def get_child(self, label):
         """
-        Returns a list of the tips in the tree
+        Returns the direct child of this node labelled `label`.
 
         Args:
-            node (treemaker.Tree): (optional) parent node. Default is current 
-                node.
+            label (str): Label for the child node.
 
         Returns:
-            List[treemaker.Tree]: the tip nodes from the given node.
+            treemaker.Tree: the first child matching `label`, or None.
         """
-        node = self if node is None else node
-        for child in node.children:
-            if child.is_node:  # remove yield from so we can support py2.7
-                for n in self.tips(child):
-                    yield n
-            if child.is_tip:
-                yield child
-    
-    def _sanitise(self, node):
+        return self._child_index.get(label) if self._child_index else None
+    
+    @staticmethod
+    def _sanitise(node):
         for char in BADCHARS:
             if char in node:
                 raise ValueError(
@@ -147,22 +679,142 @@ class Tree(object):
         return "<Tree: %s>" % self.node
     
     def __str__(self):
-        if not self.children:
-            return self.node
-        else:
-            out = ",".join([str(c) for c in sorted(self.children)])
-            if len(self.children) == 1:
-                return out
-            elif self.show_nodelabels:
-                return "(%s)%s" % (out, self.node)
-            else:
-                return "(%s)" % out
+        return self.newick()
+    
+    def newick(self):
+        """
+        Returns the Newick representation of the tree (without the
+        terminating semicolon).
+
+        The fragment for each subtree is cached and only rebuilt when `add`
+        changes that subtree, so writing the tree again after a small edit
+        only costs the path from the edit to the root. Caching keeps the
+        text of each subtree in memory; use `TreeMaker.write_to_handle` to
+        stream very large trees instead.
+
+        Returns:
+            str: the tree in Newick format.
+        """
+        show_nodelabels = self.show_nodelabels
+        stack = [(self, False)]
+        while stack:
+            node, ready = stack.pop()
+            if node._newick is not None or not node.children:
+                continue
+            elif not ready:
+                stack.append((node, True))
+                stack.extend((child, False) for child in node.children)
+                continue
+            children = node.children
+            if len(children) == 1:
+                # nodes with a single child are collapsed into that child.
+                child = children[0]
+                node._newick = child._newick if child.children else child.node
+                continue
+            node._newick = "(%s)%s" % (
+                ",".join([
+                    child._newick if child.children else child.node
+                    for child in children
+                ]),
+                node.node if show_nodelabels else ""
+            )
+        return self._newick if self.children else self.node
+    
+    def _newick_chunks(self, translate=None):
+        """
+        Generates the Newick representation of the tree in pieces using an
+        explicit stack, so that very deep trees do not hit the recursion limit.
+        Cached fragments are used where available, but none are created.
+        Strings on the stack are emitted as is, nodes are expanded in place.
+        With `translate`, a dictionary of tip label -> token, the tips are
+        written as their tokens and cached fragments are not used.
+        """
+        show_nodelabels = self.show_nodelabels
+        cached = translate is None
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if not isinstance(node, Tree):
+                yield node
+                continue
+            # nodes with a single child are collapsed into that child.
+            while len(node.children) == 1 and \
+                    (node._newick is None or not cached):
+                node = node.children[0]
+            if not node.children:
+                yield node.node if cached else translate[node.node]
+                continue
+            elif cached and node._newick is not None:
+                yield node._newick
+                continue
+            yield "("
+            stack.append(
+                ")%s" % node.node if show_nodelabels else ")"
+            )
+            children = node.children
+            stack.append(children[-1])
+            for child in reversed(children[:-1]):
+                stack.append(",")
+                stack.append(child)
 
 
 class TreeMaker(object):
-    def __init__(self, label="root", nodelabels=False):
-        self.tree = Tree(label, show_nodelabels=nodelabels)
-        self._added = set()
+    """
+    Builds a `Tree` from a set of taxa and their classification strings.
+
+    Args:
+        label (str): Label for the root node (default="root")
+        nodelabels (boolean): A flag to show nodelabels or not (default=False)
+        scoped (boolean): Resolve each level of a classification among the
+            direct children of the previous level only. By default each level
+            is searched for anywhere below the previous one (default=False)
+        backend (str): How the tree is stored. One of:
+            * "tree" = one `Tree` object per node (default)
+            * "compact" = a `treemaker.compact.CompactTree`, which uses far
+              less memory per node for very large classifications. Labels
+              used on many nodes are indexed for unscoped lookups, at some
+              extra memory per use.
+
+            The "tree" backend keeps a label index in every clade (see
+            `Tree.get`), which costs memory and time in proportion to the
+            depth of each node, so "compact" is also the better choice for
+            very deep classifications.
+
+    Attributes:
+        stats (treemaker.stats.Stats): counts of the lines parsed, nodes
+            created, lookups made and Newick fragments written by this
+            `TreeMaker`.
+
+    Raises:
+        ValueError: if backend is not "tree" or "compact".
+    """
+    def __init__(self, label="root", nodelabels=False, scoped=False,
+                 backend="tree"):
+        if backend not in ('tree', 'compact'):
+            raise ValueError(
+                "Unknown backend. Please use 'tree' or 'compact'"
+            )
+        self.scoped = scoped
+        self.backend = backend
+        self.tree = self._new_tree(label, nodelabels)
+        # (leaf, classification) -> its tip node (None for the "compact"
+        # backend), in the order they were added
+        self._added = _ordered_dict()
+        # ids of the tip nodes in `_added`, made when first needed by
+        # `_prunes_in_place` and kept up to date from then on
+        self._tips = None
+        # True while every lookup has found a direct child and no label is
+        # ambiguous where it is looked up, so that the tree does not depend
+        # on the order the taxa were added in (see `apply_changes`).
+        self._unambiguous = backend == 'tree'
+        self.stats = Stats()
+    
+    def _new_tree(self, label, nodelabels):
+        """Returns an empty tree for the backend of this TreeMaker"""
+        if self.backend == 'compact':
+            from .compact import CompactTree
+            return CompactTree(label, show_nodelabels=nodelabels).root
+        return Tree(label, show_nodelabels=nodelabels)
     
     def _check_taxon(self, taxon):
         for char in "()":
@@ -175,10 +827,16 @@ class TreeMaker(object):
         """
         Adds `leaf` to the tree in the location specified by `classification`
 
+        `classification` can also be a sequence of labels, one per level,
+        which are used as they are rather than parsed:
+
+        >>> t.add('English', ('Indo-European', 'Germanic'))
+
         Args:
             leaf (str): Leaf label
-            classification (str): A classification string of a format handled
-                by `parse_classification`.
+            classification (str or tuple): A classification string of a
+                format handled by `parse_classification`, or the labels of
+                each level.
 
         Returns:
             treemaker.Tree: the tree with the new node added.
@@ -187,17 +845,56 @@ class TreeMaker(object):
             ValueError: If a duplicate leaf label or classification is given.
         """
         self._check_taxon(leaf)
+        classification = _as_key(classification)
         if (leaf, classification) in self._added:
             raise ValueError("Duplicate Taxon/Classification")
         
+        stats = self.stats
+        unambiguous = self._unambiguous
         parent = self.tree
-        for node in self.parse_classification(classification):
-            parent = parent.get_or_create(node)
-        parent.add(leaf)
-        self._added.add((leaf, classification))
+        for label in self.parse_classification(classification):
+            if self.scoped:
+                node = parent.get_child(label)
+            else:
+                node = parent.get(label)
+            stats.lookups += 1
+            if node is None:
+                if unambiguous and not self.scoped:
+                    unambiguous = self._is_new_label(parent, label)
+                node = parent.add(label)
+                stats.nodes_created += 1
+            elif unambiguous and (node.parent is not parent or node.is_tip):
+                unambiguous = False
+            parent = node
+        if unambiguous:
+            unambiguous = self._is_new_label(parent, leaf)
+        tip = parent.add(leaf)
+        stats.nodes_created += 1
+        self._added[(leaf, classification)] = \
+            tip if self.backend == 'tree' else None
+        if self._tips is not None:
+            self._tips.add(id(tip))
+        self._unambiguous = unambiguous
         return self.tree
     
-    def add_from(self, iterable):
+    def _is_new_label(self, parent, label):
+        """
+        Returns True if adding a child labelled `label` to `parent` keeps
+        the tree unambiguous: no node that `label` could be looked up from
+        already has a child with that label.
+        """
+        if self.scoped:
+            return parent.get_child(label) is None
+        elif not self.tree._index or label not in self.tree._index:
+            return True  # a label new to the whole tree
+        node = parent
+        while node is not None:
+            if node.get_child(label) is not None:
+                return False
+            node = node.parent
+        return True
+    
+    def add_from(self, iterable, bulk=False):
         """
         Adds all entries from an `iterable`. `iterable` should be a list of
         lists or a list of tuples (etc) with 2 values - the first one the taxon
@@ -209,8 +906,18 @@ class TreeMaker(object):
         >>> ]
         >>> tree = TreeMaker().add_from(iterable)
 
+        With `bulk=True` all entries are checked before any are added, so a
+        bad entry leaves the tree as it was, and each distinct classification
+        is parsed and looked up once. The same tree is built. With
+        `scoped=True`, prefixes shared between classifications are also only
+        looked up once and the label index is built once at the end, which
+        is about twice as fast for large batches. Unscoped, most of the time
+        goes on adding the nodes, so the gain is small (about 10%, see
+        `benchmarks/add_from.py`).
+
         Args:
             iterable (iter): an iterable (e.g. a list).
+            bulk (boolean): use bulk construction (default=False).
 
         Returns:
             treemaker.Tree: the tree with the new nodes added.
@@ -218,13 +925,340 @@ class TreeMaker(object):
         Raises:
             ValueError: If each member of the iterable does not contain two 
                 entries (leaf name, and classification).
+            ValueError: If a duplicate leaf label or classification is given.
         """
+        if bulk:
+            return self._add_bulk(iterable)
         for i, row in enumerate(iterable, 1):
             if len(row) != 2:
                 raise ValueError("entry %d is not a tuple or list" % i)
             self.add(row[0], row[1])
         return self.tree
+    
+    def _add_bulk(self, iterable):
+        # check everything first, in the order (and with the errors) of
+        # adding the entries one at a time, so that a bad entry leaves the
+        # tree untouched
+        rows, seen = [], set()
+        parsed = {}  # classification -> tuple of labels
+        for i, row in enumerate(iterable, 1):
+            if len(row) != 2:
+                raise ValueError("entry %d is not a tuple or list" % i)
+            leaf, classification = row[0], _as_key(row[1])
+            self._check_taxon(leaf)
+            if (leaf, classification) in self._added or \
+                    (leaf, classification) in seen:
+                raise ValueError("Duplicate Taxon/Classification")
+            if classification not in parsed:
+                labels = tuple(self.parse_classification(classification))
+                [Tree._sanitise(_as_label(label)) for label in labels]
+                parsed[classification] = labels
+            Tree._sanitise(_as_label(leaf))
+            seen.add((leaf, classification))
+            rows.append((leaf, classification))
         
+        # with scoped lookups only the direct children are searched while
+        # building, so the subtree indexes can be rebuilt once at the end.
+        deferred = self.scoped and isinstance(self.tree, Tree)
+        resolved = {}  # tuple of labels -> node
+        collecting = gc.isenabled()
+        gc.disable()  # nothing built here is garbage yet
+        try:
+            for leaf, classification in rows:
+                labels = parsed[classification]
+                if self.scoped:
+                    parent = self._resolve(labels, resolved, deferred)
+                else:
+                    parent = resolved.get(labels)
+                    if parent is None:
+                        parent = self._resolve_unscoped(labels, resolved)
+                if self._unambiguous:
+                    self._unambiguous = self._is_new_label(parent, leaf)
+                if deferred:
+                    tip = parent._attach(Tree(leaf))
+                else:
+                    if not self.scoped and self._has_label(leaf):
+                        resolved.clear()
+                    tip = parent.add(leaf)
+                self.stats.nodes_created += 1
+                self._added[(leaf, classification)] = \
+                    tip if self.backend == 'tree' else None
+                if self._tips is not None:
+                    self._tips.add(id(tip))
+        finally:
+            if deferred:
+                self.tree._reindex()
+            if collecting:
+                gc.enable()
+        return self.tree
+    
+    def _resolve(self, labels, resolved, deferred=False):
+        """
+        Returns the node for the scoped classification `labels`, reusing and
+        updating the already `resolved` prefixes.
+        """
+        depth = len(labels)
+        while depth and labels[:depth] not in resolved:
+            depth -= 1
+        parent = resolved[labels[:depth]] if depth else self.tree
+        stats = self.stats
+        for depth in range(depth, len(labels)):
+            label = labels[depth]
+            node = parent.get_child(label)
+            stats.lookups += 1
+            if node is None:
+                if self._unambiguous:
+                    self._unambiguous = self._is_new_label(parent, label)
+                if deferred:
+                    node = parent._attach(Tree(label))
+                else:
+                    node = parent.add(label)
+                stats.nodes_created += 1
+            elif self._unambiguous and node.is_tip:
+                self._unambiguous = False
+            resolved[labels[:depth + 1]] = node
+            parent = node
+        return parent
+    
+    def _resolve_unscoped(self, labels, resolved):
+        """
+        Returns the node for the unscoped classification `labels`, and adds
+        it to the `resolved` classifications.
+        
+        Unscoped lookups search whole subtrees, so a resolved classification
+        can change when a node is added with a label that is already in the
+        tree. `resolved` is then cleared. A label new to the tree cannot
+        change any lookup made so far, and nor can the nodes added here:
+        they are below the nodes found for the earlier levels.
+        """
+        stats = self.stats
+        parent = self.tree
+        for label in labels:
+            node = parent.get(label)
+            stats.lookups += 1
+            if node is None:
+                if self._unambiguous:
+                    self._unambiguous = self._is_new_label(parent, label)
+                if resolved and self._has_label(label):
+                    resolved.clear()
+                node = parent.add(label)
+                stats.nodes_created += 1
+            elif self._unambiguous and \
+                    (node.parent is not parent or node.is_tip):
+                self._unambiguous = False
+            parent = node
+        resolved[labels] = parent
+        return parent
+    
+    def _has_label(self, label):
+        """Returns True if a node below the root is labelled `label`"""
+        if isinstance(self.tree, Tree):
+            return label in (self.tree._index or ())
+        return label in self.tree.tree._label_ids
+    
+    def apply_changes(self, added=(), removed=()):
+        """
+        Updates the tree for a change to the classification: the `removed`
+        entries are taken out and the `added` ones put in. A changed entry
+        (e.g. a taxon moved to another subgroup) is a removal plus an
+        addition. Clades left without any taxa are removed.
+        
+        The result is the tree that building the remaining entries followed
+        by the added ones from scratch would give. As long as no label is
+        ambiguous where it is looked up (e.g. no taxon shares a name with a
+        clade it could be mistaken for, and every level of a classification
+        is found directly below the previous one), the tree does not depend
+        on the order the entries were added in. The changes are then applied
+        in place, at a cost proportional to the number of changes. Otherwise,
+        and for the "compact" backend, the tree is rebuilt.
+
+        Args:
+            added (iter): (leaf, classification) entries to add.
+            removed (iter): (leaf, classification) entries to remove.
+
+        Returns:
+            treemaker.Tree: the updated tree.
+
+        Raises:
+            ValueError: if an entry to remove was never added, an entry to
+                add is already there (and not removed), or an entry is not a
+                valid (leaf, classification) pair. The tree is left as it was.
+        """
+        return self._apply_changes(added, removed)
+    
+    def update(self, old_filename, new_filename):
+        """
+        Updates a tree read from `old_filename` to match `new_filename`, an
+        edited version of it, by applying only the entries that differ (see
+        `apply_changes`). The result is identical to reading `new_filename`
+        into a new TreeMaker.
+
+        Args:
+            old_filename (str): the classification the tree was built from.
+            new_filename (str): the new version of the classification.
+
+        Returns:
+            treemaker.Tree: the updated tree.
+
+        Raises:
+            ValueError: if a line in either file is not able to be parsed, or
+                the tree was not built from `old_filename`.
+        """
+        old = list(_mmap_rows(old_filename))
+        new = list(_mmap_rows(new_filename))
+        old_rows, new_rows = set(old), set(new)
+        self.stats.lines_parsed += len(old) + len(new)
+        return self._apply_changes(
+            [row for row in new if row not in old_rows],
+            [row for row in old if row not in new_rows],
+            order=new
+        )
+    
+    def _apply_changes(self, added, removed, order=None):
+        """
+        Implements `apply_changes`. If the tree has to be rebuilt, the
+        entries are added in `order` if given.
+        """
+        added, removed = list(added), list(removed)
+        gone, new = set(), set()
+        for i, row in enumerate(removed, 1):
+            if len(row) != 2:
+                raise ValueError("removed entry %d is not a tuple or list" % i)
+            row = (row[0], _as_key(row[1]))
+            if row not in self._added or row in gone:
+                raise ValueError("Taxon/Classification not found: %s, %s" % row)
+            gone.add(row)
+        for i, row in enumerate(added, 1):
+            if len(row) != 2:
+                raise ValueError("added entry %d is not a tuple or list" % i)
+            row = added[i - 1] = (row[0], _as_key(row[1]))
+            self._check_taxon(row[0])
+            labels = self.parse_classification(row[1]) + [row[0]]
+            [Tree._sanitise(_as_label(label)) for label in labels]
+            if (row in self._added and row not in gone) or row in new:
+                raise ValueError("Duplicate Taxon/Classification")
+            new.add(row)
+        
+        if self._unambiguous:
+            for leaf, classification in gone:
+                self._remove_row(leaf, classification)
+            for leaf, classification in added:
+                self.add(leaf, classification)
+            if self._unambiguous:
+                return self.tree
+            # the additions made the tree depend on the order of the entries
+        else:
+            for row in gone:
+                del self._added[row]
+            for row in added:
+                self._added[row] = None
+        self._rebuild(list(self._added) if order is None else order)
+        return self.tree
+    
+    def remove(self, leaf, classification, prune=True):
+        """
+        Removes the taxon added as `leaf` with `classification`.
+
+        With `prune` set, clades left without any taxa are removed too, and
+        the result is the same as `apply_changes(removed=[...])`. This is
+        done in place, at about the cost of adding the taxon, when the tree
+        is unambiguous (see `apply_changes`) or when the removed clades were
+        made for this taxon alone, so that no other entry was resolved
+        through them. Otherwise, and always for the "compact" backend, the
+        tree is rebuilt from the remaining entries, which costs about as
+        much as building it.
+
+        Without `prune` only the taxon is removed, in place.
+
+        Args:
+            leaf (str): Leaf label
+            classification (str or tuple): the classification it was added
+                with.
+            prune (boolean): also remove the clades left with no taxa
+                (default=True)
+
+        Returns:
+            treemaker.Tree: the tree with the taxon removed.
+
+        Raises:
+            ValueError: if the taxon was not added with this classification
+                or is no longer in the tree, or if `prune` is not set and
+                other taxa were added below it.
+        """
+        classification = _as_key(classification)
+        row = (leaf, classification)
+        if row not in self._added:
+            raise ValueError("Taxon/Classification not found: %s, %s" % row)
+        tip = self._added[row]
+        if tip is not None and not self.tree._contains(tip):
+            raise ValueError("Taxon %s is no longer in the tree" % leaf)
+        if tip is None:
+            # the compact backend (or a tree loaded from a compact snapshot)
+            # does not know its nodes, so it is rebuilt
+            return self._apply_changes((), [row])
+        if prune:
+            if self._unambiguous or not self._prunes_in_place(tip):
+                return self._apply_changes((), [row])
+            self._remove_row(leaf, classification)
+            return self.tree
+        if tip.children:
+            raise ValueError("Other taxa were added below taxon %s" % leaf)
+        self._remove_row(leaf, classification, prune=False)
+        return self.tree
+    
+    def _prunes_in_place(self, tip):
+        """
+        Returns True if removing `tip` and the clades it leaves empty gives
+        the tree that rebuilding from the remaining entries would. That is
+        so if the removed clades are not also taxa, and were made when `tip`
+        was added rather than found by the lookups of its classification:
+        then no other entry was resolved through them, and every lookup of
+        the other entries finds the same node without them.
+        """
+        if tip.children:
+            return False
+        node, clades = tip, []
+        while node.parent is not self.tree and len(node.parent.children) == 1:
+            node = node.parent
+            clades.append(node)
+        if clades:
+            if self._tips is None:
+                self._tips = set(map(id, self._added.values()))
+            if any(id(clade) in self._tips for clade in clades):
+                return False
+        # the nodes made for an entry are the last ones of its path, so if
+        # the parent of the removed clades had a child before them, none of
+        # the remaining clades were made for `tip`.
+        parent = node.parent
+        return parent is self.tree or parent._first < node._seq
+    
+    def _remove_row(self, leaf, classification, prune=True):
+        """
+        Removes the taxon added as (`leaf`, `classification`), along with any
+        clades left empty if `prune` is set.
+        """
+        node = self._added.pop((leaf, classification))
+        if self._tips is not None:
+            self._tips.discard(id(node))
+        if prune:
+            while node.parent is not self.tree and \
+                    len(node.parent.children) == 1:
+                node = node.parent
+        elif node.parent is not self.tree and len(node.parent.children) == 1:
+            # the empty clade is written as a taxon, which a new build
+            # from the remaining entries would not have.
+            self._unambiguous = False
+        node.parent._detach(node)
+    
+    def _rebuild(self, rows):
+        """Replaces the tree with one built from `rows`"""
+        self.tree = self._new_tree(self.tree.node, self.tree.show_nodelabels)
+        self._added = _ordered_dict()
+        if self._tips is not None:
+            self._tips = set()  # filled in again as the rows are added
+        self._unambiguous = self.backend == 'tree'
+        self.add_from(rows, bulk=True)
+    
     def parse_classification(self, classification):
         """
         Parses a classification string into nodes.
@@ -234,15 +1268,18 @@ class TreeMaker(object):
 
         Args:
             classification (str): a classification string e.g.
-                "clade 1, clade 2, clade 3"
+                "clade 1, clade 2, clade 3", or a sequence of labels, which
+                is returned as a list unchanged.
 
         Returns:
             List: a list of the classification nodes.
         """
+        if not isinstance(classification, STRING_TYPES):
+            return list(classification)
         # simple for now, but easily subclassed for more complicated schema
         return [node.strip() for node in classification.strip().split(",")]
     
-    def read(self, filename):
+    def read(self, filename, workers=None, memory_map=False, cache=None):
         """
         Reads data from `filename` and constructs a tree.
         
@@ -253,8 +1290,32 @@ class TreeMaker(object):
             Taxon3   FamilyA, GroupB
             ... etc
 
+        `filename` can also be "-" for standard input, or a file object or
+        any iterator of lines. Files ending in ".gz", ".bz2" or ".xz" are
+        decompressed as they are read. These are read line by line, so
+        `workers` and `memory_map` only apply to uncompressed files and
+        `cache` only to files.
+
+        With `workers` set, the file is split into line-aligned byte ranges
+        that are parsed in a pool of `workers` processes and then added to
+        the tree in file order, giving the same tree (and errors) as reading
+        it serially.
+
+        With `memory_map` set, the file is memory-mapped and lines are split
+        on the raw bytes, decoding only the taxon and classification fields.
+        Lines containing non-ASCII text fall back to the normal parser, so
+        the results are the same.
+
+        With a `cache`, a TreeMaker that has nothing added yet looks for the
+        tree built from a file with the same content and settings in the
+        cache, and stores the tree there after building it if it is not.
+
         Args:
-            filename (str): a filename containing the classification.
+            filename (str): a filename containing the classification, or a
+                file object or iterator of lines.
+            workers (int): (optional) number of processes to parse with.
+            memory_map (boolean): (optional) use the memory-mapped reader.
+            cache (treemaker.cache.BuildCache): (optional) a build cache.
 
         Returns:
             treemaker.Tree: a `Tree` with the specified classification.
@@ -262,17 +1323,103 @@ class TreeMaker(object):
         Raises:
             ValueError: if a line in the file is not able to be parsed.
         """
-        with codecs.open(filename, 'r', encoding="utf8") as handle:
-            for i, line in enumerate(handle, 1):
-                line = line.strip()
-                if not line:
-                    continue  # skip empty lines
-                
-                if not IS_WHITESPACE.findall(line):
-                    raise ValueError(
-                        "Malformed line %d -- I need one space: %s" % (i, line)
-                    )
-                self.add(*[_.strip() for _ in IS_WHITESPACE.split(line, 1)])
+        if not _is_filename(filename) or filename == '-':
+            cache = None  # only files can be looked up in the cache
+        if cache is not None and not self._added and not self.tree.children:
+            key = cache.key(filename, self)
+            cached = cache.get(key, backend=self.backend)
+            if cached is not None:
+                self.stats.cache_hits += 1
+                self.tree, self._added = cached.tree, cached._added
+                self._tips = None
+                self._unambiguous = cached._unambiguous
+                return self.tree
+            self.stats.cache_misses += 1
+            self.read(filename, workers=workers, memory_map=memory_map)
+            cache.put(key, self)
+            return self.tree
+        plain = _is_filename(filename) and filename != '-' and \
+            not _is_compressed(filename)
+        if workers is not None and workers > 1 and plain:
+            return self._read_parallel(filename, workers)
+        if memory_map and plain:
+            rows = _mmap_rows(filename)
+        else:
+            rows = _text_rows(filename)
+        stats = self.stats
+        for row in rows:
+            stats.lines_parsed += 1
+            self.add(*row)
+        return self.tree
+    
+    def read_table(self, filename, delimiter=",", header=True, taxon=0,
+                   levels=None):
+        """
+        Reads a table with a column for the taxa and one column for each
+        level of the classification, and constructs a tree::
+
+            taxon,family,subgroup1,subgroup2
+            Taxon1,FamilyA,GroupA,SubgroupA
+            Taxon2,FamilyA,GroupA,SubgroupB
+            Taxon3,FamilyA,GroupB,
+
+        The table is read with the `csv` module, so fields can be quoted and
+        contain the delimiter. The levels are added as they are (see `add`)
+        rather than joined and parsed as a classification string, so each
+        taxon is added with the tuple of its levels. Empty levels, and
+        levels missing from the end of short rows, are skipped. Rows are
+        read one at a time, and `filename` can be anything `read` takes.
+
+        Args:
+            filename (str): a filename containing the table, or a file object
+                or iterator of lines.
+            delimiter (str): the field delimiter, e.g. "\\t" for
+                tab-separated tables (default=",")
+            header (boolean): the first row names the columns (default=True)
+            taxon (int or str): the index or (with `header`) name of the
+                taxon column (default=0)
+            levels (list): the indexes or names of the level columns, from
+                the top level down. Default is every column after `taxon`.
+
+        Returns:
+            treemaker.Tree: a `Tree` with the specified classification.
+
+        Raises:
+            ValueError: if a column is not found, a row has no taxon, or a
+                duplicate taxon and classification is given.
+        """
+        stats = self.stats
+        rows = _table_rows(filename, delimiter, header, taxon, levels)
+        for row in rows:
+            stats.lines_parsed += 1
+            self.add(*row)
+        return self.tree
+    
+    def _read_parallel(self, filename, workers):
+        from concurrent.futures import ProcessPoolExecutor
+        offsets = _split_file(filename, workers * 4)
+        rows, lineno, error = [], 0, None
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunks = pool.map(
+                _read_chunk, [filename] * (len(offsets) - 1),
+                offsets[:-1], offsets[1:]
+            )
+            for chunk, nlines, error in chunks:
+                rows.extend(chunk)
+                if error is not None:
+                    error = (lineno + error[0], error[1])
+                    break
+                lineno += nlines
+        self.stats.lines_parsed += len(rows)
+        try:
+            self.add_from(rows, bulk=True)
+        except ValueError:
+            # a bad entry leaves the tree untouched, so add the entries in
+            # turn to stop where (and with the error) a serial read does
+            self.add_from(rows)
+            raise
+        if error is not None:
+            parse_line(error[1], error[0])  # raises the serial error
         return self.tree
     
     def write(self, mode="newick"):
@@ -290,60 +1437,476 @@ class TreeMaker(object):
         Raises:
             ValueError: if mode is not "nexus" or "newick".
         """
+        head, tail = self._wrapper(mode)
+        return "%s%s%s" % (head, self.tree.newick(), tail)
+    
+    def _wrapper(self, mode, translate=False, trees=None):
+        """
+        Returns the text that goes before and after the tree for `mode`.
+        """
         if mode == 'newick':
-            return "%s;" % str(self.tree)
+            if translate or trees is not None:
+                raise ValueError(
+                    "Translate tables and several trees need nexus mode"
+                )
+            return ("", ";")
         elif mode == 'nexus':
-            return NEXUS_TEMPLATE % {
-                'label': self.tree.node if self.tree.node else 'tree',
-                'tree': str(self.tree),
-            }
+            head, tail = NEXUS_TEMPLATE.split("%(tree)s")
+            label = self.tree.node if self.tree.node else 'tree'
+            return (head % {'label': label}, tail % {})
         else:
             raise ValueError(
                 "Unknown output mode. Please use 'nexus' or 'newick'"
             )
-        
-    def write_to_file(self, filename, mode="nexus"):
+    
+    def write_to_handle(self, handle, mode="newick", bufsize=BUFSIZE,
+                        translate=False, trees=None):
         """
-        Writes the tree to `filename`.
+        Streams the output form of the tree to the file-like object `handle`
+        (e.g. `sys.stdout`) as the tree is traversed, without building the
+        whole document in memory first. The content written is identical to
+        `write`.
+
+        In nexus mode, several trees can be written to one file, and a taxa
+        block and translate table can list each taxon once so that the
+        trees refer to them by number:
+
+        >>> families = [(family.node, family) for family in t.tree.children]
+        >>> t.write_to_handle(handle, "nexus", translate=True, trees=families)
+
+        Args:
+            handle (file): a file-like object opened for writing text.
+            mode (str): An output mode. One of:
+                * "nexus" = a nexus file is generated
+                * "newick" = a newick file (bare tree) is generated
+            bufsize (int): approximate number of characters to collect
+                before each call to `handle.write`.
+            translate (boolean): write a taxa block and translate table, and
+                number the taxa in the trees (default=False)
+            trees (list): (label, node) pairs of the trees to write, e.g.
+                subtrees or `Tree.subset` trees. Default is the whole tree.
+
+        Returns:
+            None
+
+        Raises:
+            ValueError: if mode is not "nexus" or "newick", or `translate`
+                or `trees` are used in newick mode.
+        """
+        head, tail = self._wrapper(mode, translate, trees)
+        if translate or trees is not None:
+            return self._write_nexus(handle, trees, translate, bufsize)
+        handle.write(head)
+        self._stream(handle, self.tree._newick_chunks(), tail, bufsize)
+    
+    def _write_nexus(self, handle, trees, translate, bufsize):
+        """
+        Streams a NEXUS document with the (label, node) `trees`, and a taxa
+        block and translate table if `translate` is set.
+        """
+        if trees is None:
+            trees = [(self.tree.node if self.tree.node else 'tree', self.tree)]
+        trees = list(trees)
+        handle.write("#NEXUS\n\n")
+        table = None
+        if translate:
+            table, taxa = {}, []
+            for label, tree in trees:
+                for tip in (tree.tips() if tree.children else [tree]):
+                    if tip.node not in table:
+                        taxa.append(tip.node)
+                        table[tip.node] = str(len(taxa))
+            handle.write(
+                "begin taxa;\n   dimensions ntax=%d;\n   taxlabels\n" % len(taxa)
+            )
+            for i in range(0, len(taxa), 10000):
+                handle.write("".join(
+                    "      %s\n" % _nexus_token(taxon)
+                    for taxon in taxa[i:i + 10000]
+                ))
+            handle.write("   ;\nend;\n\nbegin trees;\n   translate\n")
+            for i in range(0, len(taxa), 10000):
+                handle.write("".join(
+                    "      %d %s%s\n" % (
+                        number, _nexus_token(taxon),
+                        "," if number < len(taxa) else ""
+                    )
+                    for number, taxon in enumerate(taxa[i:i + 10000], i + 1)
+                ))
+            handle.write("   ;\n")
+        else:
+            handle.write("begin trees;\n")
+        for label, tree in trees:
+            handle.write("   tree %s = " % _nexus_token(label))
+            self._stream(handle, tree._newick_chunks(table), ";\n", bufsize)
+        handle.write("end;\n")
+    
+    def _stream(self, handle, chunks, tail, bufsize):
+        """
+        Writes the Newick `chunks` and then `tail` to `handle`, `bufsize`
+        characters at a time.
+        """
+        # every "(" is matched by a closing chunk, so the chunks that are
+        # not "(" or "," are one per tip, clade or cached fragment.
+        stats = self.stats
+        buffer, size = [], 0
+        for chunk in chunks:
+            buffer.append(chunk)
+            size += len(chunk)
+            if size >= bufsize:
+                stats.fragments_written += \
+                    len(buffer) - buffer.count("(") - buffer.count(",")
+                handle.write("".join(buffer))
+                buffer, size = [], 0
+        stats.fragments_written += \
+            len(buffer) - buffer.count("(") - buffer.count(",")
+        buffer.append(tail)
+        handle.write("".join(buffer))
+    
+    def write_to_file(self, filename, mode="nexus", translate=False,
+                      trees=None):
+        """
+        Writes the tree to `filename`. The output is streamed to the file
+        rather than built in memory first.
         
 
         Args:
             mode (str): An output mode. One of:
                 * "nexus" = a nexus file is generated
                 * "newick" = a newick file (bare tree) is generated
+            translate (boolean): in nexus mode, write a taxa block and
+                translate table (see `write_to_handle`, default=False)
+            trees (list): in nexus mode, (label, node) pairs of the trees to
+                write. Default is the whole tree.
         
         Returns:
             None
 
         Raises:
             IOError: if `filename` already exists.
-            ValueError: if mode is not "nexus" or "newick".
+            ValueError: if mode is not "nexus" or "newick", or `translate`
+                or `trees` are used in newick mode.
         """
         if os.path.isfile(filename):
             raise IOError("File %s already exists" % filename)
         
-        if mode == 'nexus':
-            content = self.write(mode="nexus")
-        elif mode == 'newick':
-            content = self.write(mode="newick")
+        # check the options before creating the file
+        self._wrapper(mode, translate, trees)
+        
+        with codecs.open(filename, 'w') as handle:
+            self.write_to_handle(
+                handle, mode=mode, translate=translate, trees=trees
+            )
+    
+    def save_snapshot(self, filename):
+        """
+        Saves the tree to `filename` as a binary snapshot (see
+        `treemaker.snapshot`) that `load_snapshot` reads back much faster
+        than the classification can be rebuilt.
+
+        Args:
+            filename (str): the snapshot file. It is replaced if it exists.
+
+        Returns:
+            None
+        """
+        from .snapshot import save
+        save(self, filename)
+    
+    @classmethod
+    def load_snapshot(cls, filename, backend="tree"):
+        """
+        Loads a TreeMaker saved with `save_snapshot`. The tree, settings and
+        added taxa are restored, so `write` gives the same output and more
+        taxa can be added.
+
+        Args:
+            filename (str): the snapshot file.
+            backend (str): how the tree is stored, "tree" or "compact".
+
+        Returns:
+            treemaker.TreeMaker: the loaded TreeMaker.
+
+        Raises:
+            ValueError: if the file is not a valid snapshot.
+        """
+        from .snapshot import load
+        return load(filename, backend=backend)
+
+
+def _nexus_token(label):
+    """Returns `label`, quoted if NEXUS would read it as several tokens"""
+    if label and not NEXUS_PUNCTUATION.search(label):
+        return label
+    return "'%s'" % label.replace("'", "''")
+
+
+def parse_line(line, lineno):
+    """
+    Parses one line of a classification file.
+
+    Args:
+        line (str): the line.
+        lineno (int): the line number, for error messages.
+
+    Returns:
+        tuple: (taxon, classification), or None if the line is empty.
+
+    Raises:
+        ValueError: if the line is not able to be parsed.
+    """
+    line = line.strip()
+    if not line:
+        return None  # skip empty lines
+    
+    if not IS_WHITESPACE.findall(line):
+        raise ValueError(
+            "Malformed line %d -- I need one space: %s" % (lineno, line)
+        )
+    return tuple([_.strip() for _ in IS_WHITESPACE.split(line, 1)])
+
+
+def _as_key(classification):
+    """
+    Returns `classification` in the form used in `TreeMaker._added`: strings
+    as they are, and sequences of labels as tuples.
+    """
+    if isinstance(classification, STRING_TYPES):
+        return classification
+    return tuple(classification)
+
+
+def _as_label(value):
+    """
+    Returns `value` as a label: strings (including unicode strings in python
+    2.7) as they are, and anything else (e.g. numbers) converted with `str`.
+    """
+    if isinstance(value, STRING_TYPES):
+        return value
+    return str(value)
+
+
+def _seq_position(nodes, seq):
+    """
+    Returns the position of `seq` in `nodes`, a list of nodes in `_seq`
+    order.
+    """
+    lo, hi = 0, len(nodes)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if nodes[mid]._seq < seq:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _is_filename(source):
+    return isinstance(source, STRING_TYPES)
+
+
+def _is_compressed(filename):
+    return os.path.splitext(filename)[1].lower() in COMPRESSED
+
+
+def _open_input(filename):
+    """
+    Opens `filename` for reading text, decompressing it as it is read if it
+    ends in ".gz", ".bz2" or ".xz". "-" is standard input.
+    """
+    if filename == '-':
+        stdin = getattr(sys.stdin, 'buffer', sys.stdin)  # bytes in python 3
+        return codecs.getreader("utf8")(stdin)
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.gz':
+        import gzip
+        handle = gzip.open(filename, 'rb')
+    elif extension == '.bz2':
+        import bz2
+        handle = bz2.BZ2File(filename, 'rb')
+    elif extension == '.xz':
+        import lzma  # python 3 only
+        handle = lzma.open(filename, 'rb')
+    else:
+        return codecs.open(filename, 'r', encoding="utf8")
+    return codecs.getreader("utf8")(handle)
+
+
+def _text_rows(source):
+    """
+    Generates the (taxon, classification) rows in `source`, a filename (see
+    `_open_input`), a file object or an iterator of lines.
+    """
+    if _is_filename(source):
+        handle = _open_input(source)
+        try:
+            for row in _text_rows(handle):
+                yield row
+        finally:
+            if source != '-':  # leave standard input open
+                handle.close()
+        return
+    for i, line in enumerate(source, 1):
+        if isinstance(line, bytes):
+            line = line.decode("utf8")
+        row = parse_line(line, i)
+        if row is not None:
+            yield row
+
+
+def _table_rows(source, delimiter=",", header=True, taxon=0, levels=None):
+    """
+    Generates the (taxon, tuple of levels) rows in the table `source` (see
+    `TreeMaker.read_table`).
+    """
+    if _is_filename(source):
+        handle = _open_input(source)
+        try:
+            for row in _table_rows(handle, delimiter, header, taxon, levels):
+                yield row
+        finally:
+            if source != '-':  # leave standard input open
+                handle.close()
+        return
+    reader = csv.reader(
+        (line.decode("utf8") if isinstance(line, bytes) else line
+         for line in source),
+        delimiter=delimiter
+    )
+    names = next(reader, None) if header else None
+    if header and names is None:
+        return  # an empty table
+    
+    def column(key):
+        if names is not None and not isinstance(key, int):
+            if key not in names:
+                raise ValueError("Column not found: %s" % key)
+            return names.index(key)
+        elif not isinstance(key, int):
+            raise ValueError(
+                "Columns can only be named with a header: %s" % key
+            )
+        return key
+    
+    taxon = column(taxon)
+    if levels is not None:
+        levels = [column(level) for level in levels]
+    for row in reader:
+        if not row:
+            continue  # skip empty lines
+        name = row[taxon].strip() if taxon < len(row) else ""
+        if levels is None:
+            cells = row[taxon + 1:]
         else:
+            cells = [row[i] for i in levels if i < len(row)]
+        cells = tuple(filter(None, [cell.strip() for cell in cells]))
+        if not name:
+            if not cells:
+                continue  # a row of empty fields
             raise ValueError(
-                "Unknown output mode. Please use 'nexus' or 'newick'"
+                "Malformed line %d -- no taxon: %s" % (
+                    reader.line_num, delimiter.join(row)
+                )
             )
-        
-        with codecs.open(filename, 'w') as handle:
-            handle.write(content)
+        yield (name, cells)
 
 
-def parse_args(args):
+def _mmap_rows(filename, blocksize=1 << 20):
+    """
+    Generates the (taxon, classification) rows in `filename` by memory-mapping
+    it and working on the raw bytes a block of lines at a time.
+    """
+    with open(filename, 'rb') as handle:
+        size = os.fstat(handle.fileno()).st_size
+        if not size:
+            return
+        data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            lineno, start = 0, 0
+            while start < size:
+                end = data.find(b"\n", start + blocksize)
+                end = size if end == -1 else end + 1
+                block = data[start:end]
+                start = end
+                if NEEDS_DECODING.search(block):
+                    # let the text parser deal with unicode and odd newlines
+                    for line in block.decode("utf8").splitlines():
+                        lineno += 1
+                        row = parse_line(line, lineno)
+                        if row is not None:
+                            yield row
+                    continue
+                lines = block.split(b"\n")
+                if block.endswith(b"\n"):
+                    lines.pop()
+                for line in lines:
+                    lineno += 1
+                    fields = line.split(None, 1)
+                    if not fields:
+                        continue  # skip empty lines
+                    elif len(fields) == 1:
+                        parse_line(line.decode("utf8"), lineno)  # raises
+                    yield (
+                        fields[0].decode("utf8"),
+                        fields[1].strip().decode("utf8")
+                    )
+        finally:
+            data.close()
+
+
+def _split_file(filename, nchunks):
+    """
+    Returns the byte offsets that split `filename` into at most `nchunks`
+    ranges that start at the beginning of a line.
+    """
+    size = os.path.getsize(filename)
+    offsets = [0]
+    with open(filename, 'rb') as handle:
+        for i in range(1, nchunks):
+            handle.seek(max(offsets[-1], size * i // nchunks))
+            handle.readline()
+            if handle.tell() >= size:
+                break
+            if handle.tell() > offsets[-1]:
+                offsets.append(handle.tell())
+    offsets.append(size)
+    return offsets
+
+
+def _read_chunk(filename, start, end):
+    """
+    Parses the lines in bytes `start` to `end` of `filename`.
+
+    Returns a tuple of (rows, number of lines, error) where error is None or
+    the (line number within the chunk, line) of the first malformed line.
+    """
+    with open(filename, 'rb') as handle:
+        handle.seek(start)
+        lines = handle.read(end - start).decode("utf8").splitlines()
+    rows = []
+    for i, line in enumerate(lines, 1):
+        try:
+            row = parse_line(line, i)
+        except ValueError:
+            return (rows, i, (i, line))
+        if row is not None:
+            rows.append(row)
+    return (rows, len(lines), None)
+
+
+def parse_options(args):
     """
     Parses command line arguments
 
-    Returns a tuple of (inputfile, method, outputfile)
+    Returns an `argparse.Namespace` with all the options.
     """
     descr = 'Constructs a tree from a classification table'
     parser = argparse.ArgumentParser(description=descr)
-    parser.add_argument("input", help="inputfile")
+    parser.add_argument(
+        "inputs", nargs='*', metavar='input',
+        help="inputfile, '-' for standard input, or a .gz, .bz2 or .xz file "
+             "(several can be given with --outdir)"
+    )
     parser.add_argument(
         '-o', "--output", dest='output', default=None,
         help="output file", action='store'
@@ -352,25 +1915,357 @@ def parse_args(args):
         '-m', "--mode", dest='mode', choices=['nexus', 'newick'], default="newick",
         help="output mode: nexus or newick", action='store'
     )
+    parser.add_argument(
+        '-f', "--format", dest='format', choices=['text', 'csv', 'tsv'],
+        default="text", action='store',
+        help="input format: text (taxon and classification string), or csv "
+             "or tsv with a header, a taxon column and a column per level"
+    )
     parser.add_argument(
         '-l', "--labels", dest='nodelabels', default=False,
         help="show node labels", action='store_true'
     )
+    parser.add_argument(
+        '-j', "--jobs", dest='jobs', default=None, type=int,
+        help="number of processes to read the input with (or, in batch "
+             "mode, to build the inputs with)", action='store'
+    )
+    parser.add_argument(
+        "--save-snapshot", dest='save_snapshot', default=None, metavar='FILE',
+        help="also save the built tree as a binary snapshot in FILE",
+        action='store'
+    )
+    parser.add_argument(
+        "--load-snapshot", dest='load_snapshot', default=False,
+        help="the input is a snapshot saved with --save-snapshot",
+        action='store_true'
+    )
+    parser.add_argument(
+        "--cache", dest='cache', default=os.environ.get('TREEMAKER_CACHE'),
+        metavar='DIR', action='store',
+        help="reuse trees built from identical inputs, stored in DIR "
+             "(default: $TREEMAKER_CACHE, if set)"
+    )
+    parser.add_argument(
+        "--cache-size", dest='cache_size', default=1024, type=int,
+        metavar='MB', help="largest size of the cache (default: 1024)",
+        action='store'
+    )
+    parser.add_argument(
+        "--no-cache", dest='cache', action='store_const', const=None,
+        help="do not use the cache"
+    )
+    parser.add_argument(
+        "--batch", dest='batch', default=None, metavar='MANIFEST',
+        help="build every input listed in MANIFEST, a file of lines with "
+             "an input and (optionally) a tab and an output file",
+        action='store'
+    )
+    parser.add_argument(
+        "--outdir", dest='outdir', default=None,
+        help="directory for the outputs in batch mode", action='store'
+    )
+    parser.add_argument(
+        "--taxa", dest='taxa', default=None, metavar='FILE',
+        help="only write the tree for the taxa listed in FILE, one per line",
+        action='store'
+    )
+    parser.add_argument(
+        "--distances", dest='distances', default=None, metavar='FILE',
+        help="also write the tip-by-tip distance matrix to FILE as "
+             "tab-separated text (needs NumPy)", action='store'
+    )
+    parser.add_argument(
+        "--distance-kind", dest='distance_kind', default='shared',
+        choices=['shared', 'patristic'], action='store',
+        help="distances are the depth of the common ancestor (shared) or "
+             "the number of branches between tips (patristic)"
+    )
+    parser.add_argument(
+        "--translate", dest='translate', default=False,
+        help="write a taxa block and translate table, and number the taxa "
+             "in the trees (nexus mode)", action='store_true'
+    )
+    parser.add_argument(
+        "--per-family", dest='per_family', default=False,
+        help="write one tree per top-level group rather than one tree "
+             "(nexus mode)", action='store_true'
+    )
+    parser.add_argument(
+        "--stats", dest='stats', default=False,
+        help="print time, peak memory and counts per phase to stderr",
+        action='store_true'
+    )
+    parser.add_argument(
+        "--profile", dest='profile', default=None, metavar='FILE',
+        help="save cProfile output for the run to FILE", action='store'
+    )
     args = parser.parse_args(args)
     
-    if not os.path.isfile(args.input):
-        raise IOError("File %s does not exist" % args.input)
+    if (args.translate or args.per_family) and args.mode != 'nexus':
+        parser.error("--translate and --per-family need --mode nexus")
     
+    args.input = None
+    if args.batch is None and args.outdir is None:
+        if len(args.inputs) != 1:
+            parser.error("one input is needed, or use --outdir or --batch")
+        args.input = args.inputs[0]
+        if args.load_snapshot and args.format != 'text':
+            parser.error("--format cannot be used with --load-snapshot")
+        if args.input == '-':
+            if args.load_snapshot:
+                parser.error("--load-snapshot needs a file, not '-'")
+        elif not os.path.isfile(args.input):
+            raise IOError("File %s does not exist" % args.input)
+        if args.taxa is not None and not os.path.isfile(args.taxa):
+            raise IOError("File %s does not exist" % args.taxa)
+    elif args.taxa is not None or args.distances is not None:
+        parser.error("--taxa and --distances need a single input")
+    elif args.translate or args.per_family:
+        parser.error("--translate and --per-family need a single input")
+    elif args.format != 'text':
+        parser.error("--format needs a single input")
+    elif args.stats or args.profile is not None:
+        parser.error("--stats and --profile need a single input")
+    elif args.save_snapshot is not None or args.load_snapshot:
+        parser.error("--save-snapshot and --load-snapshot need a single input")
+    elif args.output is not None:
+        parser.error("use --outdir rather than --output with several inputs")
+    elif args.batch is not None and not os.path.isfile(args.batch):
+        raise IOError("File %s does not exist" % args.batch)
+    elif args.batch is None and not args.inputs:
+        parser.error("no inputs given")
+    
+    return args
+
+
+def parse_args(args):
+    """
+    Parses command line arguments
+
+    Returns a tuple of (inputfile, method, outputfile, nodelabels)
+    """
+    args = parse_options(args)
     return (args.input, args.mode, args.output, args.nodelabels)
 
 
 def main(args=None):  # pragma: no cover
     if args is None:
         args = sys.argv[1:]
-    infile, mode, outfile, nodelabels = parse_args(args)
-    t = TreeMaker(nodelabels=nodelabels)
-    t.read(infile)
-    if outfile is None:
-        print(t.write(mode=mode))
+    args = parse_options(args)
+    if args.input is None:
+        failures = [job for job in _run_batch(args) if job[2] is not None]
+        if failures:
+            sys.stderr.write("%d file(s) failed\n" % len(failures))
+            return 1
+        return
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            t = _run(args)
+        finally:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
     else:
-        t.write_to_file(outfile, mode=mode)
+        t = _run(args)
+    if args.stats:
+        t.stats.report(sys.stderr)
+
+
+def _run(args):
+    """
+    Builds and writes the tree for the parsed command line `args`, timing
+    each phase in `TreeMaker.stats`.
+
+    Returns:
+        treemaker.TreeMaker: the TreeMaker used.
+    """
+    stats = Stats()
+    cache = None
+    # only text files can be looked up in the cache
+    if args.input != '-' and args.format == 'text':
+        cache = _open_cache(args.cache, args.cache_size)
+    if args.load_snapshot:
+        with stats.phase("load"):
+            t = TreeMaker.load_snapshot(args.input)
+        t.stats = stats
+        t.tree.show_nodelabels = args.nodelabels
+    else:
+        t = TreeMaker(nodelabels=args.nodelabels)
+        t.stats = stats
+        if args.format != 'text':
+            with stats.phase("read"):
+                t.read_table(args.input, delimiter=DELIMITERS[args.format])
+        elif args.stats and not args.jobs and cache is None:
+            # parse the file first so reading and building are timed apart
+            with stats.phase("read"):
+                rows = list(_text_rows(args.input))
+            stats.lines_parsed += len(rows)
+            with stats.phase("build"):
+                t.add_from(rows)
+        else:
+            with stats.phase("read"):
+                t.read(args.input, workers=args.jobs, cache=cache)
+            if cache is not None:
+                sys.stderr.write("cache %s: %s\n" % (
+                    "hit" if stats.cache_hits else "miss", args.input
+                ))
+    if args.save_snapshot:
+        with stats.phase("snapshot"):
+            t.save_snapshot(args.save_snapshot)
+    if args.taxa:
+        with stats.phase("subset"):
+            # only the tree is written from here on
+            t.tree = t.tree.subset(_read_taxa(args.taxa))
+    if args.distances:
+        if os.path.isfile(args.distances):
+            raise IOError("File %s already exists" % args.distances)
+        from .distances import write_distances
+        with stats.phase("distances"):
+            with codecs.open(args.distances, 'w', encoding="utf8") as handle:
+                write_distances(t.tree, handle, kind=args.distance_kind)
+    trees = None
+    if args.per_family:
+        trees = [(family.node, family) for family in t.tree.children]
+    with stats.phase("write"):
+        if args.output is None:
+            t.write_to_handle(
+                sys.stdout, mode=args.mode, translate=args.translate,
+                trees=trees
+            )
+            sys.stdout.write("\n")
+        else:
+            t.write_to_file(
+                args.output, mode=args.mode, translate=args.translate,
+                trees=trees
+            )
+    return t
+
+
+def _read_taxa(filename):
+    """
+    Returns the taxa listed in `filename`, one per line. Blank lines are
+    skipped.
+    """
+    with codecs.open(filename, 'r', encoding="utf8") as handle:
+        return [line.strip() for line in handle if line.strip()]
+
+
+def _batch_jobs(args):
+    """
+    Returns the (input, output) pairs to build for the parsed command line
+    `args`, from the --batch manifest and any inputs given with --outdir.
+    Paths in the manifest are relative to the manifest.
+    """
+    pairs = []
+    if args.batch is not None:
+        base = os.path.dirname(args.batch)
+        with codecs.open(args.batch, 'r', encoding="utf8") as handle:
+            for line in handle:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                fields = [f.strip() for f in line.split("\t", 1)]
+                output = fields[1] if len(fields) > 1 and fields[1] else None
+                pairs.append((
+                    os.path.join(base, fields[0]),
+                    None if output is None else os.path.join(base, output)
+                ))
+    pairs.extend((filename, None) for filename in args.inputs)
+    
+    extension = '.nex' if args.mode == 'nexus' else '.nwk'
+    jobs = []
+    for filename, output in pairs:
+        if output is None and args.outdir is not None:
+            name = os.path.basename(filename)
+            if _is_compressed(name):
+                name = os.path.splitext(name)[0]
+            name = os.path.splitext(name)[0]
+            output = os.path.join(args.outdir, name + extension)
+        jobs.append((filename, output))
+    return jobs
+
+
+def _open_cache(directory, size):
+    """
+    Returns a `treemaker.cache.BuildCache` in `directory` that holds up to
+    `size` megabytes, or None if `directory` is None.
+    """
+    if directory is None:
+        return None
+    from .cache import BuildCache
+    return BuildCache(directory, max_size=size * 1024 * 1024)
+
+
+def _build_file(filename, output, mode, nodelabels, cache=None, cache_size=0):
+    """
+    Builds the tree for `filename` and writes it to `output`, using the
+    build cache in the directory `cache` if given.
+
+    Returns:
+        tuple: (error message or None if it worked, True if the tree came
+            from the cache)
+    """
+    try:
+        if output is None:
+            raise ValueError("no output file given, use --outdir")
+        t = TreeMaker(nodelabels=nodelabels)
+        t.read(filename, cache=_open_cache(cache, cache_size))
+        t.write_to_file(output, mode=mode)
+    except Exception as e:  # report it, and carry on with the other files
+        return (str(e), False)
+    return (None, t.stats.cache_hits > 0)
+
+
+def _run_batch(args):
+    """
+    Builds every input of a batch in a pool of `args.jobs` processes (by
+    default, one per CPU) and reports how each one went on stderr. A failed
+    input does not stop the others.
+
+    Returns:
+        List[tuple]: (input, output, error message or None) for each input.
+    """
+    jobs = _batch_jobs(args)
+    if args.outdir is not None and not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+    
+    results, todo, outputs = {}, [], set()
+    for i, (filename, output) in enumerate(jobs):
+        if output is not None and output in outputs:
+            results[i] = ("output %s is used by another input" % output, False)
+        else:
+            outputs.add(output)
+            todo.append(i)
+    
+    if (args.jobs is None or args.jobs > 1) and len(todo) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            n = len(todo)
+            done = pool.map(
+                _build_file,
+                [jobs[i][0] for i in todo], [jobs[i][1] for i in todo],
+                [args.mode] * n, [args.nodelabels] * n, [args.cache] * n,
+                [args.cache_size] * n
+            )
+            results.update(zip(todo, done))
+    else:
+        for i in todo:
+            results[i] = _build_file(
+                jobs[i][0], jobs[i][1], args.mode, args.nodelabels,
+                args.cache, args.cache_size
+            )
+    
+    report = []
+    for i, (filename, output) in enumerate(jobs):
+        error, cached = results[i]
+        if error is None:
+            sys.stderr.write("ok      %s -> %s%s\n" % (
+                filename, output, " (cached)" if cached else ""
+            ))
+        else:
+            sys.stderr.write("FAILED  %s: %s\n" % (filename, error))
+        report.append((filename, output, error))
+    return report